@@ -0,0 +1,70 @@
+# Default package imports begin #
+from hashlib import sha256
+from os import link, makedirs, replace
+from os.path import dirname, exists, join
+from shutil import copyfile
+from uuid import uuid4
+# Default package imports end #
+
+# Third party package imports begin #
+# Third party package imports end #
+
+# Local package imports begin #
+# Local package imports end #
+
+# Header info begins #
+__author__ = "Brian Balsamo"
+__copyright__ = "Copyright 2015, The University of Chicago"
+__version__ = "0.0.2"
+__maintainer__ = "Brian Balsamo"
+__email__ = "balsamo@uchicago.edu"
+__status__ = "Development"
+# Header info ends #
+
+"""
+A content addressed store of preservation format conversions, so that a
+file whose bytes have already been converted elsewhere gets a link to the
+earlier output instead of a new conversion.
+"""
+
+
+# Functions begin #
+class ConversionCache(object):
+    # Outputs are filed under a key made from the source digest and
+    # everything that decides what the converter produces from it,
+    # including the backend that ran it and that backend's version
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+
+    def key(self, sourceDigest, converterName, backend, target, version):
+        parts = [sourceDigest, converterName, backend, repr(target), version]
+        return sha256("\0".join(parts).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return join(self.cacheDir, key[:2], key)
+
+    def fetch(self, key, destination):
+        cached = self.path(key)
+        if not exists(cached):
+            return False
+        try:
+            link(cached, destination)
+        except FileExistsError:
+            pass
+        except OSError:
+            # Different file systems, fall back to a copy
+            copyfile(cached, destination)
+        return True
+
+    def store(self, key, source):
+        cached = self.path(key)
+        if exists(cached):
+            return
+        makedirs(dirname(cached), exist_ok=True)
+        tempPath = cached+'.'+uuid4().hex+'.tmp'
+        try:
+            link(source, tempPath)
+        except OSError:
+            copyfile(source, tempPath)
+        replace(tempPath, cached)
+# Functions end #
@@ -0,0 +1,176 @@
+# Default package imports begin #
+from binascii import hexlify, unhexlify
+from mmap import mmap, ACCESS_READ
+from os import replace
+from os.path import exists, getmtime, splitext
+from struct import Struct
+# Default package imports end #
+
+# Third party package imports begin #
+# Third party package imports end #
+
+# Local package imports begin #
+from stagingFixity import fixityLogLine, iterFixityLog
+# Local package imports end #
+
+# Header info begins #
+__author__ = "Brian Balsamo"
+__copyright__ = "Copyright 2015, The University of Chicago"
+__version__ = "0.0.2"
+__maintainer__ = "Brian Balsamo"
+__email__ = "balsamo@uchicago.edu"
+__status__ = "Development"
+# Header info ends #
+
+"""
+A compact, memory mappable companion format for the staging fixity logs.
+
+An index file is a header, a table of fixed width records sorted by path
+and a table holding each distinct path once. A record holds the offset and
+length of its path plus the raw sha256 and md5 digests, so lookups are a
+binary search over the mapped file and nothing has to be parsed up front.
+"""
+
+# Functions begin #
+magic = b'LDRFIX\x00\x01'
+headerStruct = Struct('<8sQQ')
+recordStruct = Struct('<QI32s16s')
+
+
+def indexPathFor(fixityLog):
+    return splitext(fixityLog)[0]+'.idx'
+
+
+class FixityIndex(object):
+    def __init__(self, indexPath):
+        self.file = open(indexPath, 'rb')
+        self.map = mmap(self.file.fileno(), 0, access=ACCESS_READ)
+        fileMagic, self.count, self.pathsOffset = \
+            headerStruct.unpack_from(self.map, 0)
+        if fileMagic != magic:
+            self.close()
+            raise ValueError(indexPath+" is not a fixity index")
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __len__(self):
+        return self.count
+
+    def record(self, position):
+        pathOffset, pathLength, sha256Digest, md5Digest = \
+            recordStruct.unpack_from(self.map, headerStruct.size +
+                                     position*recordStruct.size)
+        start = self.pathsOffset + pathOffset
+        return self.map[start:start+pathLength], sha256Digest, md5Digest
+
+    def find(self, key):
+        wanted = key.encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low+high)//2
+            if self.record(middle)[0] < wanted:
+                low = middle+1
+            else:
+                high = middle
+        if low < self.count:
+            found = self.record(low)
+            if found[0] == wanted:
+                return found
+        return None
+
+    def get(self, key, default=None):
+        found = self.find(key)
+        if found is None:
+            return default
+        return [hexlify(found[1]).decode('ascii'),
+                hexlify(found[2]).decode('ascii')]
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def items(self):
+        for position in range(self.count):
+            path, sha256Digest, md5Digest = self.record(position)
+            yield path.decode('utf-8'), \
+                [hexlify(sha256Digest).decode('ascii'),
+                 hexlify(md5Digest).decode('ascii')]
+
+    def __iter__(self):
+        for path, digests in self.items():
+            yield path
+
+    def keys(self):
+        return iter(self)
+
+
+def writeFixityIndex(entries, indexPath):
+    # Later entries win, as they do when a text log is read into a dict
+    hashes = {}
+    for path, digests in entries:
+        hashes[path.encode('utf-8')] = digests
+    paths = sorted(hashes)
+
+    tempPath = indexPath+'.tmp'
+    with open(tempPath, 'wb') as f:
+        f.write(headerStruct.pack(magic, len(paths), headerStruct.size +
+                                  len(paths)*recordStruct.size))
+        pathOffset = 0
+        for path in paths:
+            sha256Hash, md5Hash = hashes[path]
+            f.write(recordStruct.pack(pathOffset, len(path),
+                                      unhexlify(sha256Hash),
+                                      unhexlify(md5Hash)))
+            pathOffset += len(path)
+        for path in paths:
+            f.write(path)
+    replace(tempPath, indexPath)
+
+
+def writeFixityLogFromIndex(indexPath, fixityLog):
+    index = FixityIndex(indexPath)
+    try:
+        with open(fixityLog, 'w') as f:
+            for path, digests in index.items():
+                f.write(fixityLogLine(path, digests[0], digests[1]))
+    finally:
+        index.close()
+
+
+def isFixityIndex(path):
+    with open(path, 'rb') as f:
+        return f.read(len(magic)) == magic
+
+
+def openFixityLog(fixityLog):
+    # Prefer the index when it is at least as new as the text log it was
+    # built from, otherwise fall back to reading the text log
+    indexPath = indexPathFor(fixityLog)
+    if exists(indexPath) and \
+            (not exists(fixityLog) or
+             getmtime(indexPath) >= getmtime(fixityLog)):
+        return FixityIndex(indexPath)
+    return dict(iterFixityLog(fixityLog))
+
+
+def readFixityLog(fixityLog):
+    fixity = openFixityLog(fixityLog)
+    if isinstance(fixity, FixityIndex):
+        try:
+            return dict(fixity.items())
+        finally:
+            fixity.close()
+    return fixity
+
+
+def closeFixityLog(fixity):
+    if isinstance(fixity, FixityIndex):
+        fixity.close()
+# Functions end #
@@ -2,9 +2,19 @@
 
 # Default package imports begin #
 from argparse import ArgumentParser
-from os import _exit
+from concurrent.futures import ThreadPoolExecutor
+from os import _exit, killpg, makedirs, remove, scandir, sep
 from os.path import split, exists, splitext, basename, isdir, isfile, abspath, \
-    join
+    join, normpath, relpath, getsize, lexists
+from queue import Queue
+from shutil import copyfile, rmtree
+from signal import SIGKILL, SIGTERM
+from subprocess import CompletedProcess, PIPE, Popen, STDOUT, TimeoutExpired
+import tarfile
+from tempfile import mkdtemp
+from threading import BoundedSemaphore, Condition, Lock
+from time import sleep, time
+from zipfile import ZipFile, is_zipfile
 # Default package imports end #
 
 # Third party package imports begin #
@@ -19,7 +29,9 @@ from uchicagoldrLogging.filters import UserAndIPFilter
 
 from uchicagoldr.batch import Batch
 from uchicagoldr.item import Item
-from uchicagoldr.bash_cmd import BashCommand
+
+from conversionCache import ConversionCache
+from stagingFixity import hashFile
 # Local package imports end #
 
 # Header info begins #
@@ -59,179 +71,218 @@ def parseResult(result,filepath):
         logger.info("Conversion run")
 
 
-def audioConverter(item):
-    if not exists(item.get_file_path()+'.presform.wav'):
-        audioConvertArgs = ['ffmpeg', '-n', '-i', item.get_file_path(),
-                            item.get_file_path()+'.presform.wav']
-        audioConvertCommand = BashCommand(audioConvertArgs)
-        audioConvertCommand.set_timeout(timeout)
-        audioConvertCommand.run_command()
-        logger.debug(audioConvertCommand.get_data())
-        return audioConvertCommand.get_data()
-    else:
-        logger.info("Audio (wav) preservation format for file exists. " +
-                    "Not Clobbering.")
-        return (None, None)
-
-
-def videoConverter(item):
-    if not exists(item.get_file_path()+'.presform.avi'):
-        videoConvertArgs = ['ffmpeg', '-n', '-i', item.get_file_path(),
-                            '-vcodec', 'rawvideo', '-acodec', 'pcm_u24le',
-                            '-pix_fmt', 'uyvy422', '-vtag', '2vuy',
-                            item.get_file_path()+".presform.avi"]
-        videoConvertCommand = BashCommand(videoConvertArgs)
-        videoConvertCommand.set_timeout(timeout)
-        videoConvertCommand.run_command()
-        logger.debug(videoConvertCommand.get_data())
-        return videoConvertCommand.get_data()
-    else:
-        logger.info("Video (avi) preservation format for file exists. " +
-                    "Not Clobbering.")
-        return (None, None)
+# Preservation targets, as (suffix, ffmpeg output arguments, description)
+wavTarget = ('.presform.wav', [], "Audio (wav)")
+aviTarget = ('.presform.avi', ['-vcodec', 'rawvideo', '-acodec', 'pcm_u24le',
+                               '-pix_fmt', 'uyvy422', '-vtag', '2vuy'],
+             "Video (avi)")
+tifTarget = ('.presform.tif', [], "Image (tif)")
+# and as (suffix, LibreOffice --convert-to argument, description)
+pdfTarget = ('.presform.pdf', 'pdf', "Office (PDF)")
+csvTarget = ('.presform.csv', 'csv', "Office (CSV)")
+txtTarget = ('.presform.txt', 'txt:Text', "Office (TXT)")
 
 
-def imageConverter(item):
-    if not exists(item.get_file_path()+'.presform.tif'):
-        imageConvertArgs = ['ffmpeg', '-n', '-i', item.get_file_path(),
-                            item.get_file_path()+'.presform.tif']
-        imageConvertCommand = BashCommand(imageConvertArgs)
-        imageConvertCommand.set_timeout(timeout)
-        imageConvertCommand.run_command()
-        logger.debug(imageConvertCommand.get_data())
-        return imageConvertCommand.get_data()
-    else:
-        logger.info("Image (tif) preservaiton format for file exists. " +
-                    "Not Clobbering.")
-        return(None, None)
+def ffmpegConverter(item, targets):
+    # A single ffmpeg run decodes the source once and writes every target
+    ffmpegArgs = ['ffmpeg', '-n', '-i', item.get_file_path()]
+    for suffix, outputArgs, description in targets:
+        ffmpegArgs += outputArgs + [item.get_file_path()+suffix]
+    result = runCommand(ffmpegArgs, 'ffmpeg', getsize(item.get_file_path()))
+    logger.debug(result)
+    return result
 
 
 def gifConverter(item):
-    if not exists(item.get_file_path()+'.presform'):
-        mkdirArgs = ['mkdir', item.get_file_path()+".presform"]
-        mkdirCommand = BashCommand(mkdirArgs)
-        mkdirCommand.run_command()
-        gifConvertArgs = ['ffmpeg', '-n', '-i', item.get_file_path(),
-                          item.get_file_path() +
-                          '.presform/output%04d.presform.tif']
-        gifConvertCommand = BashCommand(gifConvertArgs)
-        gifConvertCommand.set_timeout(timeout)
-        gifConvertCommand.run_command()
-        logger.debug(gifConvertCommand.get_data())
-        return gifConvertCommand.get_data()
-    else:
+    if exists(item.get_file_path()+'.presform') or \
+            exists(item.get_file_path()+'.presform.tif'):
         logger.info("Image (tif) preservation format for file exists. " +
                     "Not Clobbering.")
         return(None, None)
+    if gifMode == 'multipage':
+        # Every frame goes into one multi-page TIFF
+        gifConvertArgs = ['convert']
+        if gifThreads:
+            gifConvertArgs += ['-limit', 'thread', str(gifThreads)]
+        gifConvertArgs += [item.get_file_path(), '-coalesce',
+                           item.get_file_path()+'.presform.tif']
+    else:
+        makedirs(item.get_file_path()+'.presform')
+        gifConvertArgs = ['ffmpeg', '-n', '-i', item.get_file_path()]
+        if gifThreads:
+            gifConvertArgs += ['-threads', str(gifThreads)]
+        gifConvertArgs += [item.get_file_path() +
+                           '.presform/output%04d.presform.tif']
+    result = runCommand(gifConvertArgs, 'ffmpeg',
+                        getsize(item.get_file_path()))
+    logger.debug(result)
+    reportGifOutput(item)
+    return result
+
+
+def reportGifOutput(item):
+    if gifMode == 'multipage':
+        target = item.get_file_path()+'.presform.tif'
+        if not exists(target):
+            return
+        frames = 'an unknown number of'
+        data = runCommand(['identify', '-ping', '-format', '%n\\n', target],
+                          'ffmpeg', 0)
+        if data[0] == True and data[1].returncode == 0 and data[1].stdout:
+            output = data[1].stdout
+            if isinstance(output, bytes):
+                output = output.decode('utf-8', 'replace')
+            frames = output.split()[0]
+        size = getsize(target)
+    else:
+        frames = 0
+        size = 0
+        for entry in scandir(item.get_file_path()+'.presform'):
+            if entry.is_file():
+                frames += 1
+                size += entry.stat().st_size
+    logger.info("GIF "+item.get_file_path()+" produced "+str(frames) +
+                " frame(s), "+str(size)+" bytes")
 
 
 def zipConverter(item):
-    if not exists(item.get_file_path()+'.presform.extracted'):
-        unzipCommandArgs = ['7z', 'x',
-                            '-o'+item.get_file_path()+'.presform.extracted',
-                            item.get_file_path()]
-        unzipCommand = BashCommand(unzipCommandArgs)
-        unzipCommand.set_timeout(timeout)
-        unzipCommand.run_command()
-        if exists(item.get_file_path()+'.presform.extracted'):
-            b = Batch(root, item.get_file_path()+'.presform.extracted')
-            for item in b.find_items(from_directory=True):
-                itemStack.append(item)
-        return unzipCommand.get_data()
-    else:
+    global pending
+    if exists(item.get_file_path()+'.presform.extracted'):
         logger.info("Already extracted.")
         return(None, None)
-
-
-def officeConverter(item):
-    if not exists(item.get_file_path()+'.presform.pdf'):
-        fileName, fileExtension = splitext(item.get_file_path())
-        mkdirArgs = ['mkdir', '-p', '/tmp/officeConv']
-        mkdirCommand = BashCommand(mkdirArgs)
-        mkdirCommand.set_timeout(timeout)
-        mkdirCommand.run_command()
-        officeConvertArgs = ['/Applications/LibreOffice.app/Contents/MacOS/soffice',
-                             '--headless', '--convert-to', 'pdf',
-                             '--outdir', '/tmp/officeConv',
-                             item.get_file_path()]
-        officeConvertCommand = BashCommand(officeConvertArgs)
-        officeConvertCommand.set_timeout(timeout)
-        officeConvertCommand.run_command()
-        cpCommandArgs = ['cp', '/tmp/officeConv/'+basename(fileName)+'.pdf',
-                         item.get_file_path()+'.presform.pdf']
-        cpCommand = BashCommand(cpCommandArgs)
-        cpCommand.run_command()
-        rmCommandArgs = ['rm', '-r', '/tmp/officeConv']
-        rmCommand = BashCommand(rmCommandArgs)
-        rmCommand.run_command()
-        logger.debug(officeConvertCommand.get_data())
-        return officeConvertCommand.get_data()
-    else:
-        logger.info("Office (PDF) preservation format for file exists. " +
-                    "Not Clobbering.")
-        return(None, None)
-
-
-def xlsConverter(item):
-    if not exists(item.get_file_path()+'.presform.csv'):
-        fileName, fileExtension = splitext(item.get_file_path())
-        mkdirArgs = ['mkdir', '-p', '/tmp/officeConv']
-        mkdirCommand = BashCommand(mkdirArgs)
-        mkdirCommand.set_timeout(timeout)
-        mkdirCommand.run_command()
-        officeConvertArgs = ['/Applications/LibreOffice.app/Contents/MacOS/soffice',
-                             '--headless', '--convert-to', 'csv',
-                             '--outdir', '/tmp/officeConv',
-                             item.get_file_path()]
-        officeConvertCommand = BashCommand(officeConvertArgs)
-        officeConvertCommand.set_timeout(timeout)
-        officeConvertCommand.run_command()
-        cpCommandArgs = ['cp', '/tmp/officeConv/'+basename(fileName)+'.csv',
-                         item.get_file_path()+'.presform.csv']
-        cpCommand = BashCommand(cpCommandArgs)
-        cpCommand.set_timeout(timeout)
-        cpCommand.run_command()
-        rmCommandArgs = ['rm', '-r', '/tmp/officeConv']
-        rmCommand = BashCommand(rmCommandArgs)
-        rmCommand.set_timeout(timeout)
-        rmCommand.run_command()
-        logger.debug(officeConvertCommand.get_data())
-        return officeConvertCommand.get_data()
-    else:
-        logger.info("Office (CSV) preservation format for file exists. " +
-                    "Not Clobbering.")
+    depth = relpath(item.get_file_path(), root).count('.presform.extracted')
+    if maxDepth is not None and depth >= maxDepth:
+        logger.warn("Not extracting "+item.get_file_path()+", archives " +
+                    "are nested more than "+str(maxDepth)+" deep")
         return(None, None)
+    # Archives are expanded on their own threads, so a conversion worker is
+    # never left waiting for queue space that only it could free
+    with pendingCondition:
+        pending += 1
+    archiveExecutor.submit(extractArchive, item)
+    logger.info("Extraction of "+item.get_file_path()+" queued")
+    return(None, None)
 
 
-def txtConverter(item):
-    if not exists(item.get_file_path()+'.presform.txt'):
-        fileName, fileExtension = splitext(item.get_file_path())
-        mkdirArgs = ['mkdir', '-p', '/tmp/officeConv']
-        mkdirCommand = BashCommand(mkdirArgs)
-        mkdirCommand.set_timeout(timeout)
-        mkdirCommand.run_command()
-        officeConvertArgs = ['/Applications/LibreOffice.app/Contents/MacOS/soffice',
-                             '--headless', '--convert-to', 'txt:Text',
-                             '--outdir', '/tmp/officeConv',
-                             item.get_file_path()]
-        officeConvertCommand = BashCommand(officeConvertArgs)
-        officeConvertCommand.set_timeout(timeout)
-        officeConvertCommand.run_command()
-        cpCommandArgs = ['cp', '/tmp/officeConv/'+basename(fileName)+'.txt',
-                         item.get_file_path()+'.presform.txt']
-        cpCommand = BashCommand(cpCommandArgs)
-        cpCommand.set_timeout(timeout)
-        cpCommand.run_command()
-        rmCommandArgs = ['rm', '-r', '/tmp/officeConv']
-        rmCommand = BashCommand(rmCommandArgs)
-        rmCommand.set_timeout(timeout)
-        rmCommand.run_command()
-        logger.debug(officeConvertCommand.get_data())
-        return officeConvertCommand.get_data()
-    else:
-        logger.info("Office (CSV) preservation format for file exists. " +
-                    "Not Clobbering.")
-        return(None, None)
+def extractArchive(item):
+    global pending
+    try:
+        destination = item.get_file_path()+'.presform.extracted'
+        if tarfile.is_tarfile(item.get_file_path()) or \
+                is_zipfile(item.get_file_path()):
+            try:
+                for memberPath in archiveMembers(item.get_file_path(),
+                                                 destination):
+                    schedule(Item(memberPath, root))
+                result = (True, CompletedProcess(['extract',
+                                                  item.get_file_path()], 0))
+            except Exception as e:
+                result = (False, e)
+        else:
+            unzipCommandArgs = ['7z', 'x', '-o'+destination,
+                                item.get_file_path()]
+            result = runCommand(unzipCommandArgs, 'archive',
+                                getsize(item.get_file_path()))
+            if exists(destination):
+                b = Batch(root, destination)
+                for member in b.find_items(from_directory=True):
+                    schedule(member)
+        parseResult(result, item.get_file_path())
+    except Exception as e:
+        logger.error("Extraction failed on "+item.get_file_path() +
+                     " ("+str(e)+")")
+    finally:
+        with pendingCondition:
+            pending -= 1
+            pendingCondition.notify_all()
+
+
+def archiveMembers(archivePath, destination):
+    # Yields each member as soon as it has been written out, so it can be
+    # converted while the rest of the archive is still being extracted. A
+    # tar ending with a zip member passes is_zipfile, so tars are checked
+    # for first.
+    if tarfile.is_tarfile(archivePath):
+        with tarfile.open(archivePath) as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                memberPath = normpath(join(destination, member.name))
+                if not memberPath.startswith(normpath(destination)+sep):
+                    logger.warn("Not extracting "+member.name+" from " +
+                                archivePath+", it would land outside " +
+                                destination)
+                    continue
+                archive.extract(member, destination, set_attrs=False)
+                yield memberPath
+        return
+    with ZipFile(archivePath) as archive:
+        for member in archive.infolist():
+            if not member.filename.endswith('/'):
+                yield archive.extract(member, destination)
+
+
+def libreOfficeConverter(item, targets):
+    # All of an item's office targets are converted in one job, so they share
+    # a warm instance or a single LibreOffice profile
+    result = (None, None)
+    if officeServers is not None:
+        # Hand the file to one of the warm LibreOffice instances rather than
+        # starting a new one
+        server = officeServers.get()
+        try:
+            host, port = server.rsplit(':', 1)
+            for suffix, convertTo, description in targets:
+                unoconvertArgs = ['unoconvert', '--host', host,
+                                  '--port', port,
+                                  '--convert-to', convertTo.split(':')[0]]
+                if ':' in convertTo:
+                    unoconvertArgs += ['--filter', convertTo.split(':', 1)[1]]
+                unoconvertArgs += [item.get_file_path(),
+                                   item.get_file_path()+suffix]
+                unoconvertResult = runCommand(unoconvertArgs, 'office',
+                                              getsize(item.get_file_path()))
+                logger.debug(unoconvertResult)
+                result = worstResult(result, unoconvertResult)
+        finally:
+            officeServers.put(server)
+        return result
+
+    # Every job borrows one of the pooled LibreOffice profiles, which only
+    # one soffice may use at a time, so each is initialised once per run
+    # rather than once per document. The output directory is still the
+    # job's own, so concurrent conversions can't collide or delete each
+    # other's output.
+    fileName, fileExtension = splitext(item.get_file_path())
+    profile = officeProfiles.get()
+    jobDir = mkdtemp(prefix='officeConv')
+    try:
+        for suffix, convertTo, description in targets:
+            officeConvertArgs = [soffice,
+                                 '-env:UserInstallation=file://'+profile,
+                                 '--headless', '--convert-to', convertTo,
+                                 '--outdir', join(jobDir, 'out'),
+                                 item.get_file_path()]
+            officeConvertResult = runCommand(officeConvertArgs, 'office',
+                                             getsize(item.get_file_path()))
+            logger.debug(officeConvertResult)
+            result = worstResult(result, officeConvertResult)
+            converted = join(jobDir, 'out',
+                             basename(fileName)+suffix[len('.presform'):])
+            if exists(converted):
+                copyfile(converted, item.get_file_path()+suffix)
+    finally:
+        rmtree(jobDir, ignore_errors=True)
+        officeProfiles.put(profile)
+    return result
+
+
+def worstResult(result, newResult):
+    # Keep the first failure of a multi-target job for parseResult
+    if result[0] == False or \
+            (result[0] == True and result[1].returncode != 0):
+        return result
+    return newResult
 
 
 def htmlConverter(item):
@@ -240,51 +291,16 @@ def htmlConverter(item):
         intermediaryFilePath = originalFilePath+'.intermediary.pdf'
         wkhtmltopdfArgs = ['wkhtmltopdf', item.get_file_path(),
                            intermediaryFilePath]
-        wkhtmltopdfCommand = BashCommand(wkhtmltopdfArgs)
-        wkhtmltopdfCommand.set_timeout(timeout)
-        wkhtmltopdfCommand.run_command()
+        result = runCommand(wkhtmltopdfArgs, 'html',
+                            getsize(item.get_file_path()))
         i = Item(intermediaryFilePath, root)
-        itemStack.append(i)
-        return wkhtmltopdfCommand.get_data()
+        schedule(i, wait=False)
+        return result
     else:
         return (None, None)
 
 
 def parse(item):
-    # Handy dandy lists
-    audioExtensions = ['.mp3', '.wma', '.wav', '.aiff', '.midi']
-    audioMimes = ['audio/x-aiff', 'audio/basic', 'audio/midi', 'audio/mp4',
-                  'audio/mpeg', 'audio/x-ape', 'audio/x-pn-realaudio',
-                  'audio/x-wav']
-    officeExtensions = ['.docx', '.doc', '.xls', '.xlsx', '.ppt', '.pptx',
-                        '.pdf', '.rtf']
-    officeMimes = ["application/msword", "application/vnd.ms-office",
-                   "application/vnd.ms-excel", "application/vnd.ms-powerpoint",
-                   "application/vnd.oasis.opendocument.spreadsheet",
-                   "application/vnd.oasis.opendocument.text",
-                   "application/vnd.openxmlformats-officedocument.presentationml.presentation",
-                   "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                   "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                   'text/rtf', 'application/pdf']
-    videoExtensions = [".wmv", ".vob"]
-    videoMimes = ["video/quicktime", 'video/3gpp', 'video/mp2p', 'video/mp4',
-                  'video/mpeg', 'video/mpv', 'video/x-flv', 'video/x-m4v',
-                  'video/x-ms-asf', 'video/x-msvideo']
-    imageExtensions = ['.jpg', '.jpeg', '.png', '.pct']
-    imageMimes = ["image/jpeg", "image/x-ms-bmp", 'image/x-ms-bmp',
-                  'image/png', 'image/x-paintnet', 'image/x-portable-bitmap',
-                  'image/x-portable-greymap']
-    zipExtensions = ['.zip', '.tar.gz', '.7z', '.rar']
-    zipMimes = ['application/x-7z-compressed', 'application/x-bzip2',
-                'application/x-gzip', 'application/x-rar',
-                'application/x-stuffit', 'application/x-tar',
-                'application/zip']
-    htmlExtensions = ['.html', '.htm']
-    htmlMimes = ['text/html']
-
-    excludeExtensions = ['.exe']
-    excludeMimes = ['application/x-executable']
-
     extension = item.find_file_extension().lower()
 
     # Skip cases
@@ -304,56 +320,338 @@ def parse(item):
         logger.info("Skipping - excluded extension")
         return
 
-    if item.find_file_mime_type() in excludeMimes:
+    # Detecting the mime type may mean running file, so only do it once
+    mimeType = item.find_file_mime_type()
+    if mimeType in excludeMimes:
         logger.info("Skipping - excluded mime type")
         return
 
-    # Conversion conditionals
-    if extension in audioExtensions or item.find_file_mime_type() in audioMimes:
-        logger.info("Audio extension or mime detected")
-        result = audioConverter(item)
-        parseResult(result, item.get_file_path())
-
-    if extension in officeExtensions or \
-            item.find_file_mime_type() in officeMimes:
-        logger.info("Office extension or mime detected")
-        result = officeConverter(item)
-        parseResult(result, item.get_file_path())
-
-    if extension == ".xls" or extension == ".xlsx":
-        logger.info("XLS extension detected")
-        result = xlsConverter(item)
-        parseResult(result, item.get_file_path())
-
-    if extension == ".doc" or extension == ".docx":
-        logger.info("DOC extension detected")
-        result = txtConverter(item)
-        parseResult(result, item.get_file_path())
-
-    if extension in videoExtensions or item.find_file_mime_type() in videoMimes:
-        logger.info("Video extension or mime detected")
-        result = videoConverter(item)
-        parseResult(result, item.get_file_path())
-
-    if extension in imageExtensions or item.find_file_mime_type() in imageMimes:
-        logger.info("Image extension or mime detected")
-        result = imageConverter(item)
-        parseResult(result, item.get_file_path())
-
-    if extension == ".gif":
-        logger.info("GIF extension detected")
-        result = gifConverter(item)
-        parseResult(result, item.get_file_path())
-
-    if extension in zipExtensions or item.find_file_mime_type() in zipMimes:
-        logger.info("Zip extension or mime detected")
-        result = zipConverter(item)
-        parseResult(result, item.get_file_path())
-
-    if extension in htmlExtensions or item.find_file_mime_type() in htmlMimes:
-        logger.info("HTML extension or mime detected")
-        result = htmlConverter(item)
-        parseResult(result, item.get_file_path())
+    digest = None
+    for converter, targets in planConversions(item, extension, mimeType):
+        if targets is None:
+            result = runConverter(converter, item)
+            parseResult(result, item.get_file_path())
+            continue
+
+        if conversionCache is not None:
+            if digest is None:
+                digest = hashFile(item.get_file_path())[0]
+            missingKeys = []
+            missing = []
+            for target in targets:
+                key = conversionCache.key(digest, converter.__name__,
+                                          converterBackend(converter),
+                                          target[:2], toolVersion(converter))
+                if conversionCache.fetch(key, item.get_file_path()+target[0]):
+                    logger.info(target[2]+" preservation format for file " +
+                                "found in the conversion cache.")
+                else:
+                    missing.append(target)
+                    missingKeys.append(key)
+            targets = missing
+            if not targets:
+                continue
+        else:
+            missingKeys = [None]*len(targets)
+
+        convertTargets(converter, item, targets, missingKeys)
+
+
+def convertTargets(converter, item, targets, keys):
+    result = runConverter(converter, item, targets)
+    succeeded = result[0] == True and result[1].returncode == 0
+    if converter is ffmpegConverter and len(targets) > 1 and \
+            not succeeded and not isinstance(result[1], TimeoutExpired):
+        # One output ffmpeg can't write fails the whole run, so give every
+        # target a run of its own rather than losing the ones that work.
+        # Nothing was there before, so whatever the failed run left is
+        # removed for ffmpeg -n to write over.
+        logger.warn("Converting "+item.get_file_path()+" to several " +
+                    "targets at once failed, converting them one by one")
+        for target in targets:
+            if lexists(item.get_file_path()+target[0]):
+                remove(item.get_file_path()+target[0])
+        for target, key in zip(targets, keys):
+            convertTargets(converter, item, [target], [key])
+        return
+    parseResult(result, item.get_file_path())
+    if conversionCache is not None and succeeded:
+        for target, key in zip(targets, keys):
+            if exists(item.get_file_path()+target[0]):
+                conversionCache.store(key, item.get_file_path()+target[0])
+
+
+def converterBackend(converter):
+    # Office documents go through either the warm unoserver instances or a
+    # soffice per job, which don't produce identical output
+    if converter is ffmpegConverter:
+        return 'ffmpeg'
+    if officeServers is not None:
+        return 'unoserver'
+    return 'soffice'
+
+
+def toolVersion(converter):
+    # Part of the conversion cache key, so upgrading a tool doesn't hand out
+    # outputs made by the old one. Looked up once per run.
+    with toolVersionsLock:
+        if converter not in toolVersions:
+            backend = converterBackend(converter)
+            if backend == 'ffmpeg':
+                versionArgs = ['ffmpeg', '-version']
+            elif backend == 'unoserver':
+                versionArgs = ['unoconvert', '--version']
+            else:
+                versionArgs = [soffice, '--version']
+            version = 'unknown'
+            data = runCommand(versionArgs, converterClasses[converter], 0)
+            if data[0] == True and data[1].returncode == 0 and \
+                    data[1].stdout:
+                output = data[1].stdout
+                if isinstance(output, bytes):
+                    output = output.decode('utf-8', 'replace')
+                version = output.splitlines()[0]
+            toolVersions[converter] = version
+        return toolVersions[converter]
+
+
+def planConversions(item, extension, mimeType):
+    # Work out every preservation target the item needs before converting
+    # anything, so targets produced by the same tool share one job
+    matched = set(extensionRules.get(extension, ())) | \
+        set(mimeRules.get(mimeType, ()))
+    plan = []
+    jobs = {}
+    for position in sorted(matched):
+        description, converter, target = converterRules[position]
+        logger.info(description+" extension or mime detected")
+        if target is None:
+            plan.append((converter, None))
+        elif exists(item.get_file_path()+target[0]):
+            logger.info(target[2]+" preservation format for file " +
+                        "exists. Not Clobbering.")
+        elif converter in jobs:
+            jobs[converter].append(target)
+        else:
+            jobs[converter] = [target]
+            plan.append((converter, jobs[converter]))
+    return plan
+
+
+# Which concurrency limit each converter counts against. LibreOffice can't
+# run many instances at once, ffmpeg and the others can.
+converterClasses = {
+    ffmpegConverter: 'ffmpeg',
+    gifConverter: 'ffmpeg',
+    libreOfficeConverter: 'office',
+    zipConverter: 'archive',
+    htmlConverter: 'html'
+}
+
+
+# The converter registry. Rules are looked up by extension and by mime type
+# through indexes built once at import, and are applied in the order they
+# were registered.
+converterRules = []
+extensionRules = {}
+mimeRules = {}
+
+
+def registerConverter(description, converter, target=None, extensions=(),
+                      mimes=()):
+    position = len(converterRules)
+    converterRules.append((description, converter, target))
+    for extension in extensions:
+        extensionRules.setdefault(extension, []).append(position)
+    for mime in mimes:
+        mimeRules.setdefault(mime, []).append(position)
+
+
+audioExtensions = ['.mp3', '.wma', '.wav', '.aiff', '.midi']
+audioMimes = ['audio/x-aiff', 'audio/basic', 'audio/midi', 'audio/mp4',
+              'audio/mpeg', 'audio/x-ape', 'audio/x-pn-realaudio',
+              'audio/x-wav']
+officeExtensions = ['.docx', '.doc', '.xls', '.xlsx', '.ppt', '.pptx',
+                    '.pdf', '.rtf']
+officeMimes = ["application/msword", "application/vnd.ms-office",
+               "application/vnd.ms-excel", "application/vnd.ms-powerpoint",
+               "application/vnd.oasis.opendocument.spreadsheet",
+               "application/vnd.oasis.opendocument.text",
+               "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+               "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+               "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+               'text/rtf', 'application/pdf']
+videoExtensions = [".wmv", ".vob"]
+videoMimes = ["video/quicktime", 'video/3gpp', 'video/mp2p', 'video/mp4',
+              'video/mpeg', 'video/mpv', 'video/x-flv', 'video/x-m4v',
+              'video/x-ms-asf', 'video/x-msvideo']
+imageExtensions = ['.jpg', '.jpeg', '.png', '.pct']
+imageMimes = ["image/jpeg", "image/x-ms-bmp", 'image/x-ms-bmp',
+              'image/png', 'image/x-paintnet', 'image/x-portable-bitmap',
+              'image/x-portable-greymap']
+zipExtensions = ['.zip', '.tar.gz', '.7z', '.rar']
+zipMimes = ['application/x-7z-compressed', 'application/x-bzip2',
+            'application/x-gzip', 'application/x-rar',
+            'application/x-stuffit', 'application/x-tar',
+            'application/zip']
+htmlExtensions = ['.html', '.htm']
+htmlMimes = ['text/html']
+
+excludeExtensions = frozenset(['.exe'])
+excludeMimes = frozenset(['application/x-executable'])
+
+registerConverter("Audio", ffmpegConverter, wavTarget, audioExtensions,
+                  audioMimes)
+registerConverter("Office", libreOfficeConverter, pdfTarget,
+                  officeExtensions, officeMimes)
+registerConverter("XLS", libreOfficeConverter, csvTarget, ['.xls', '.xlsx'])
+registerConverter("DOC", libreOfficeConverter, txtTarget, ['.doc', '.docx'])
+registerConverter("Video", ffmpegConverter, aviTarget, videoExtensions,
+                  videoMimes)
+registerConverter("Image", ffmpegConverter, tifTarget, imageExtensions,
+                  imageMimes)
+registerConverter("GIF", gifConverter, extensions=['.gif'])
+registerConverter("Zip", zipConverter, extensions=zipExtensions,
+                  mimes=zipMimes)
+registerConverter("HTML", htmlConverter, extensions=htmlExtensions,
+                  mimes=htmlMimes)
+
+
+def runConverter(converter, item, *args):
+    with classLimits[converterClasses[converter]]:
+        return converter(item, *args)
+
+
+def timeoutFor(converterClass, inputSize):
+    # A fixed allowance plus time per GB of input, so large files get the
+    # time they need without small ones being allowed to hang for as long
+    base, perGB = classTimeouts[converterClass]
+    if base is None and not perGB:
+        return None
+    return (base or 0) + perGB*inputSize/(1024*1024*1024)
+
+
+def limitResources(commandArgs):
+    # prlimit sets the limits and then execs the tool, so nothing has to run
+    # in the child between fork and exec, which isn't safe with threads
+    if not memoryLimit and not cpuLimit:
+        return commandArgs
+    prlimitArgs = ['prlimit']
+    if memoryLimit:
+        prlimitArgs.append('--as='+str(memoryLimit))
+    if cpuLimit:
+        prlimitArgs.append('--cpu='+str(cpuLimit))
+    return prlimitArgs + ['--'] + commandArgs
+
+
+def runCommand(commandArgs, converterClass, inputSize):
+    # Runs a tool in a process group of its own, so whatever it started can
+    # be killed along with it. Returns (success, CompletedProcess or the
+    # exception), the same as BashCommand.get_data().
+    # The tools don't see the terminal's SIGINT in their own sessions, so
+    # the running ones are tracked for main to stop when the run ends
+    try:
+        process = Popen(limitResources(commandArgs), stdout=PIPE,
+                        stderr=STDOUT, start_new_session=True)
+    except Exception as e:
+        return (False, e)
+    with runningProcessesLock:
+        runningProcesses.add(process)
+        stopped = stopping
+    if stopped:
+        killProcessGroup(process)
+    try:
+        output = process.communicate(
+            timeout=timeoutFor(converterClass, inputSize))[0]
+    except TimeoutExpired as e:
+        logger.warn(" ".join(commandArgs)+" timed out, killing it")
+        killProcessGroup(process)
+        return (False, e)
+    except BaseException:
+        killProcessGroup(process)
+        raise
+    finally:
+        with runningProcessesLock:
+            runningProcesses.discard(process)
+    return (True, CompletedProcess(commandArgs, process.returncode, output))
+
+
+def stopRunningTools():
+    # Called from main when the run ends or is interrupted. Signals every
+    # running tool's group, leaving the waiting on them to the worker
+    # threads that started them.
+    global stopping
+    with runningProcessesLock:
+        stopping = True
+        processes = list(runningProcesses)
+    for sig in (SIGTERM, SIGKILL):
+        for process in processes:
+            try:
+                killpg(process.pid, sig)
+            except ProcessLookupError:
+                pass
+        if sig == SIGTERM:
+            deadline = time()+killGrace
+            while time() < deadline and \
+                    any(process.poll() is None for process in processes):
+                sleep(0.1)
+
+
+def killProcessGroup(process):
+    # SIGTERM first so the tool can clean up, then SIGKILL for anything in
+    # the group still around after the grace period, soffice.bin and the
+    # like included
+    try:
+        killpg(process.pid, SIGTERM)
+    except ProcessLookupError:
+        pass
+    try:
+        process.wait(timeout=killGrace)
+    except TimeoutExpired:
+        pass
+    try:
+        killpg(process.pid, SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.communicate()
+
+
+def schedule(item, wait=True):
+    # Queue an item for parsing, including items found while converting
+    # others (extracted archive members, intermediary files). Once
+    # queueLimit items are waiting the caller blocks until the workers catch
+    # up, except for the workers themselves, as only they can make room.
+    global pending
+    global queued
+    with pendingCondition:
+        while wait and queued >= queueLimit:
+            pendingCondition.wait()
+        queued += 1
+        pending += 1
+    executor.submit(parseItem, item)
+
+
+def parseItem(item):
+    global pending
+    global queued
+    try:
+        logger.info("Parsing "+item.get_file_path())
+        parse(item)
+        logger.info("Parsing complete on "+item.get_file_path())
+    except Exception as e:
+        logger.error("Parsing failed on "+item.get_file_path() +
+                     " ("+str(e)+")")
+    finally:
+        with pendingCondition:
+            queued -= 1
+            pending -= 1
+            pendingCondition.notify_all()
+
+
+def waitForConversions():
+    with pendingCondition:
+        while pending > 0:
+            pendingCondition.wait()
 # Functions end #
 
 
@@ -427,6 +725,125 @@ def main():
                         action="store",
                         type=int
     )
+    parser.add_argument(
+                        '--class-timeout',
+                        help="Enter a timeout for one kind of conversion " +
+                        "(ffmpeg, office, archive or html) as " +
+                        "CLASS=SECONDS[+SECONDS_PER_GB], overriding -t. " +
+                        "Repeat for several kinds.",
+                        action="append",
+                        dest="class_timeouts",
+                        default=[]
+    )
+    parser.add_argument(
+                        '--kill-grace',
+                        help="Enter how many seconds a timed out " +
+                        "conversion gets to exit after SIGTERM before " +
+                        "it is killed",
+                        action="store",
+                        type=int,
+                        default=10
+    )
+    parser.add_argument(
+                        '--memory-limit',
+                        help="Enter the address space each conversion " +
+                        "may use, in MB",
+                        action="store",
+                        type=int
+    )
+    parser.add_argument(
+                        '--cpu-limit',
+                        help="Enter the CPU time each conversion may use, " +
+                        "in seconds",
+                        action="store",
+                        type=int
+    )
+    parser.add_argument(
+                        '--workers',
+                        help="Enter the number of files to convert " +
+                        "concurrently",
+                        action="store",
+                        type=int,
+                        default=1
+    )
+    parser.add_argument(
+                        '--office-limit',
+                        help="Enter the number of LibreOffice conversions " +
+                        "allowed to run at once",
+                        action="store",
+                        type=int,
+                        default=1
+    )
+    parser.add_argument(
+                        '--ffmpeg-limit',
+                        help="Enter the number of ffmpeg conversions " +
+                        "allowed to run at once, defaults to --workers",
+                        action="store",
+                        type=int
+    )
+    parser.add_argument(
+                        '--archive-workers',
+                        help="Enter the number of archives to extract " +
+                        "concurrently",
+                        action="store",
+                        type=int,
+                        default=1
+    )
+    parser.add_argument(
+                        '--max-depth',
+                        help="Enter how deeply nested archives may be " +
+                        "extracted, 0 to not extract archives at all",
+                        action="store",
+                        type=int,
+                        default=10
+    )
+    parser.add_argument(
+                        '--queue-size',
+                        help="Enter the number of files allowed to wait " +
+                        "for conversion at once",
+                        action="store",
+                        type=int,
+                        default=1000
+    )
+    parser.add_argument(
+                        '--gif-mode',
+                        help="Choose whether GIFs are preserved as a " +
+                        "folder of TIFF frames or as one multi-page TIFF",
+                        action="store",
+                        choices=['frames', 'multipage'],
+                        default='frames'
+    )
+    parser.add_argument(
+                        '--gif-threads',
+                        help="Enter the number of threads each GIF " +
+                        "conversion may use, defaults to the tool's choice",
+                        action="store",
+                        type=int
+    )
+    parser.add_argument(
+                        '--cache-dir',
+                        help="Enter a directory to keep converted files " +
+                        "in, keyed by the content of their source, so " +
+                        "identical files are only converted once",
+                        action="store"
+    )
+    parser.add_argument(
+                        '--soffice',
+                        help="Enter the location of the LibreOffice " +
+                        "soffice binary",
+                        action="store",
+                        default="/Applications/LibreOffice.app/Contents/" +
+                        "MacOS/soffice"
+    )
+    parser.add_argument(
+                        '--office-server',
+                        help="Enter the host:port of a running unoserver " +
+                        "(a warm LibreOffice instance) to convert office " +
+                        "documents with instead of starting soffice for " +
+                        "each file. Repeat for several instances.",
+                        action="append",
+                        dest="office_servers"
+    )
     parser.add_argument(
                         '--admindir',
                         help="Enter the location of the admin directory " +
@@ -490,25 +907,103 @@ def main():
     # End user specified log instantiation #
     try:
         # Begin module code #
-        global itemStack
-        itemStack = []
         global root
         root = abspath(args.root)
         item_path = abspath(args.item)
-        global timeout
-        timeout = args.timeout
-
-        if isdir(item_path):
-            b = Batch(root, item_path)
-            for item in b.find_items(from_directory=True):
-                itemStack.append(item)
-        if isfile(item_path):
-            itemStack.append(Item(item_path, root))
-
-        for item in itemStack:
-            logger.info("Parsing "+item.get_file_path())
-            parse(item)
-            logger.info("Parsing complete on "+item.get_file_path())
+        global classTimeouts
+        classTimeouts = {}
+        for converterClass in ['ffmpeg', 'office', 'archive', 'html']:
+            classTimeouts[converterClass] = (args.timeout, 0)
+        for classTimeout in args.class_timeouts:
+            converterClass, policy = classTimeout.split('=', 1)
+            if converterClass not in classTimeouts:
+                raise ValueError("Unknown conversion class " +
+                                 converterClass)
+            base, perGB = (policy.split('+', 1)+['0'])[:2]
+            classTimeouts[converterClass] = (float(base), float(perGB))
+        global killGrace
+        killGrace = args.kill_grace
+        global memoryLimit
+        memoryLimit = None
+        if args.memory_limit:
+            memoryLimit = args.memory_limit*1024*1024
+        global cpuLimit
+        cpuLimit = args.cpu_limit
+        global runningProcesses
+        runningProcesses = set()
+        global runningProcessesLock
+        runningProcessesLock = Lock()
+        global stopping
+        stopping = False
+
+        global soffice
+        soffice = args.soffice
+        global gifMode
+        gifMode = args.gif_mode
+        global gifThreads
+        gifThreads = args.gif_threads
+        global conversionCache
+        conversionCache = None
+        if args.cache_dir:
+            conversionCache = ConversionCache(abspath(args.cache_dir))
+        global toolVersions
+        toolVersions = {}
+        global toolVersionsLock
+        toolVersionsLock = Lock()
+        global officeServers
+        officeServers = None
+        officeLimit = args.office_limit
+        if args.office_servers:
+            officeServers = Queue()
+            for server in args.office_servers:
+                officeServers.put(server)
+            # One conversion per warm instance at a time
+            officeLimit = max(officeLimit, len(args.office_servers))
+        global officeProfiles
+        officeProfiles = Queue()
+        officeProfileDirs = []
+        if officeServers is None:
+            # One reusable profile per concurrent soffice
+            for x in range(officeLimit):
+                officeProfileDirs.append(mkdtemp(prefix='officeProfile'))
+                officeProfiles.put(officeProfileDirs[-1])
+        global classLimits
+        classLimits = {
+            'ffmpeg': BoundedSemaphore(args.ffmpeg_limit or args.workers),
+            'office': BoundedSemaphore(officeLimit),
+            'archive': BoundedSemaphore(args.workers),
+            'html': BoundedSemaphore(args.workers)
+        }
+        global maxDepth
+        maxDepth = args.max_depth
+        global queueLimit
+        queueLimit = args.queue_size
+        global pending
+        pending = 0
+        global queued
+        queued = 0
+        global pendingCondition
+        pendingCondition = Condition()
+        global executor
+        executor = ThreadPoolExecutor(max_workers=args.workers)
+        global archiveExecutor
+        archiveExecutor = ThreadPoolExecutor(
+            max_workers=args.archive_workers)
+
+        try:
+            if isdir(item_path):
+                b = Batch(root, item_path)
+                for item in b.find_items(from_directory=True):
+                    schedule(item)
+            if isfile(item_path):
+                schedule(Item(item_path, root))
+            waitForConversions()
+        finally:
+            executor.shutdown(wait=False)
+            archiveExecutor.shutdown(wait=False)
+            stopRunningTools()
+            for profileDir in officeProfileDirs:
+                rmtree(profileDir, ignore_errors=True)
         # End module code #
         logger.info("ENDS: COMPLETE")
         return 0
@@ -11,6 +11,7 @@ from sys import argv, path
 path.insert(0, "/home/tdanstrom/src/apps/ldr_lib/lib")
 
 from argparse import Action, ArgumentParser
+from csv import writer as csv_writer
 from datetime import datetime, timedelta
 from grp import getgrgid
 from pwd import getpwuid
@@ -18,12 +19,226 @@ from hashlib import md5, sha256
 from logging import DEBUG, FileHandler, Formatter, getLogger, \
     INFO, StreamHandler
 from os import _exit, stat
-from sqlalchemy import Table
+from sqlalchemy import bindparam, BigInteger, Boolean, Column, false, \
+    Table, text
+from sqlalchemy.schema import CreateColumn
 from sys import stdout
 
 from uchicagoldr.batch import Batch
 from uchicagoldr.database import Database
 
+from stagingFixity import orderedMap
+
+columns = ['filepath', 'accession', 'mimetype', 'size', 'checksum']
+
+def describe_file(a_file):
+    # mime type, size and accession mostly wait on the file system
+    if not a_file.test_readability():
+        return a_file, False
+    a_file.set_file_mime_type(a_file.find_file_mime_type())
+    a_file.set_file_size(a_file.find_file_size())
+    a_file.set_accession(a_file.find_file_accession())
+    return a_file, True
+
+def hash_file(described):
+    # hashing is the cpu bound part, and hashlib lets other threads run
+    a_file, readable = described
+    if readable:
+        a_file.set_hash(a_file.find_hash_of_file(sha256))
+    return a_file, readable
+
+def index_rows(items, io_workers=1, hash_workers=1):
+    # Both stages run on bounded pools and hand back files in walk order,
+    # so the caller is a single writer and the output order doesn't depend
+    # on the worker counts
+    described = orderedMap(describe_file, items, io_workers)
+    for a_file, readable in orderedMap(hash_file, described, hash_workers):
+        if readable:
+            yield {'filepath': a_file.filepath,
+                   'accession': a_file.get_accession(),
+                   'mimetype': a_file.get_file_mime_type(),
+                   'size': a_file.get_file_size(),
+                   'checksum': a_file.get_hash()}
+        else:
+            logger.error("{path} could not be read". \
+                         format(path=a_file.filepath))
+
+def sql_literal(value):
+    if value is None:
+        return "NULL"
+    if isinstance(value, int):
+        return str(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+def write_sql(rows, out):
+    out.write("begin transaction;\n")
+    for row in rows:
+        out.write("insert into file ({columns}) values ({values});\n". \
+                  format(columns = ",".join(columns),
+                         values = ",".join(sql_literal(row[column])
+                                           for column in columns)))
+    out.write("commit;\n")
+
+def write_csv(rows, out):
+    # Suitable for sqlite's .import or postgres' COPY ... CSV HEADER
+    writer = csv_writer(out)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([row[column] for column in columns])
+
+def open_file_table(database_url):
+    db = Database(database_url, ['file'])
+    class File(db.base):
+        __table__ = Table('file', db.metadata, autoload=True)
+    return db, File
+
+def add_state_columns(db, File):
+    # Incremental loads need the mtime (in nanoseconds, so a rewrite within
+    # the same second is still noticed) and deleted columns, which older
+    # file tables don't have. Returns whether the table was altered.
+    wanted = [Column('mtime', BigInteger),
+              Column('deleted', Boolean, nullable=False,
+                     server_default=false())]
+    bind = db.session.get_bind()
+    added = False
+    for column in wanted:
+        if column.name in File.__table__.c:
+            continue
+        logger.info("Adding the {name} column to the file table". \
+                    format(name=column.name))
+        db.session.execute(text("alter table file add column {column}". \
+                                format(column=CreateColumn(column). \
+                                       compile(dialect=bind.dialect))))
+        added = True
+    db.session.commit()
+    return added
+
+def file_state(filepath, has_mtime):
+    unix_stat_of_file = stat(filepath)
+    if has_mtime:
+        return (unix_stat_of_file.st_size, unix_stat_of_file.st_mtime_ns)
+    return (unix_stat_of_file.st_size,)
+
+def known_files(db, File, directory_path):
+    # What the file table already says about everything under the
+    # directory, plus which of those rows are flagged deleted. The trailing
+    # separator keeps /repo/acc1 from matching /repo/acc10.
+    state_columns = [File.size]
+    if 'mtime' in File.__table__.c:
+        state_columns.append(File.mtime)
+    query = db.session.query(File.filepath, *state_columns)
+    if 'deleted' in File.__table__.c:
+        query = db.session.query(File.filepath, File.deleted, *state_columns)
+    known = {}
+    flagged = set()
+    for row in query.filter(File.filepath.startswith(
+            directory_path.rstrip('/') + '/', autoescape=True)):
+        if 'deleted' in File.__table__.c:
+            if row[1]:
+                flagged.add(row[0])
+            known[row[0]] = tuple(row[2:])
+        else:
+            known[row[0]] = tuple(row[1:])
+    return known, flagged
+
+def same_state(previous, current):
+    try:
+        return tuple(int(x) for x in previous) == current
+    except (TypeError, ValueError):
+        return False
+
+def changed_items(items, known, changed, has_mtime):
+    # Only a stat per file: anything whose size (and mtime, where the table
+    # keeps one) matches its row is passed over without being hashed. Files
+    # seen are taken out of known, so what is left afterwards has gone from
+    # the file system, and the paths of changed files are collected so
+    # their rows get updated rather than inserted.
+    unchanged = 0
+    for a_file in items:
+        previous = known.pop(a_file.filepath, None)
+        try:
+            current = file_state(a_file.filepath, has_mtime)
+        except OSError:
+            current = None
+        if previous is not None and same_state(previous, current):
+            unchanged += 1
+            continue
+        if previous is not None:
+            changed.add(a_file.filepath)
+        yield a_file
+    logger.info("{count} files unchanged".format(count=unchanged))
+
+def load_database(rows, db, File, batch_size, changed=frozenset()):
+    # new files are inserted, files in changed have their rows updated
+    table = File.__table__
+    has_mtime = 'mtime' in table.c
+    insert = table.insert()
+    value_columns = [column for column in columns if column != 'filepath']
+    if has_mtime:
+        value_columns.append('mtime')
+    has_deleted = 'deleted' in table.c
+    if has_deleted:
+        value_columns.append('deleted')
+    update = table.update(). \
+        where(table.c.filepath == bindparam('old_filepath')). \
+        values(dict((column, bindparam('new_' + column))
+                    for column in value_columns))
+    inserts = []
+    updates = []
+    loaded = 0
+    def flush():
+        if inserts:
+            db.session.execute(insert, inserts)
+        if updates:
+            db.session.execute(update, updates)
+        db.session.commit()
+        del inserts[:]
+        del updates[:]
+    for row in rows:
+        if has_mtime:
+            row['mtime'] = file_state(row['filepath'], True)[1]
+        if has_deleted:
+            row['deleted'] = False
+        if row['filepath'] in changed:
+            update_row = {'old_filepath': row['filepath']}
+            for column in value_columns:
+                update_row['new_' + column] = row[column]
+            updates.append(update_row)
+        else:
+            inserts.append(row)
+        loaded += 1
+        if len(inserts) + len(updates) >= batch_size:
+            flush()
+            logger.info("{count} files loaded".format(count=loaded))
+    flush()
+    logger.info("{count} files loaded".format(count=loaded))
+
+def set_deleted(db, File, filepaths, deleted, batch_size):
+    table = File.__table__
+    filepaths = sorted(filepaths)
+    for start in range(0, len(filepaths), batch_size):
+        db.session.execute(table.update(). \
+                           where(table.c.filepath.in_(
+                               filepaths[start:start + batch_size])). \
+                           values(deleted=deleted))
+        db.session.commit()
+
+def mark_deleted(db, File, missing, flagged, batch_size):
+    # Rows are flagged where the table has a deleted column, and unflagged
+    # again for files that have come back. Otherwise missing files are
+    # only reported, as nothing is removed from the index here.
+    if 'deleted' not in File.__table__.c:
+        for filepath in sorted(missing):
+            logger.warn("{path} is in the index but no longer on the " \
+                        "filesystem".format(path=filepath))
+        return
+    # flagged rows the walk saw are no longer in missing
+    restored = flagged.difference(missing)
+    set_deleted(db, File, restored, False, batch_size)
+    set_deleted(db, File, missing, True, batch_size)
+    logger.info("{count} files marked deleted, {restored} restored". \
+                format(count=len(missing), restored=len(restored)))
+
 def main():
     parser = ArgumentParser(description="{description}". \
                             format(description = __description__),
@@ -56,7 +271,33 @@ def main():
     parser.add_argument("directory_path", 
                            help="Enter a directory that you need to work on ",
                            action='store')
+    parser.add_argument("--database",help="Enter a database url to " + \
+                        "load the index into directly, instead of " + \
+                        "writing it to stdout",
+                        action="store")
+    parser.add_argument("--incremental",help="Only hash and load files " + \
+                        "that are new or changed since the database was " + \
+                        "last loaded, and flag the ones that are gone. " + \
+                        "Adds mtime and deleted columns to the file " + \
+                        "table if it doesn't have them. Needs --database.",
+                        action="store_true")
+    parser.add_argument("--batch-size",help="Enter how many files to " + \
+                        "insert into the database at a time",
+                        action="store",dest="batch_size",type=int,
+                        default=1000)
+    parser.add_argument("--io-workers",help="Enter how many files to " + \
+                        "find the mime type, size and accession of at once",
+                        action="store",dest="io_workers",type=int,default=1)
+    parser.add_argument("--hash-workers",help="Enter how many files to " + \
+                        "hash at once",
+                        action="store",dest="hash_workers",type=int,
+                        default=1)
+    parser.add_argument("--format",help="Choose whether the index is " + \
+                        "written to stdout as sql statements or as csv",
+                        action="store",choices=['sql','csv'],default='sql')
     args = parser.parse_args()
+    if args.incremental and not args.database:
+        parser.error("--incremental needs --database")
     log_format = Formatter( \
                             "[%(levelname)s] %(asctime)s  " + \
                             "= %(message)s",
@@ -82,32 +323,35 @@ def main():
         generator_object = b.find_items(from_directory=True)
         logger.debug(generator_object)
         b.set_items(generator_object)
-        stdout.write("begin transaction;\n")
-        for a_file in b.get_items():
-            if a_file.test_readability():
-                
-                file_hash = a_file.find_hash_of_file(sha256)
-                mime = a_file.find_file_mime_type()
-                size = a_file.find_file_size()
-                accession = a_file.find_file_accession()
-                a_file.set_file_mime_type(mime)
-                a_file.set_file_size(size)
-                a_file.set_hash(file_hash)
-                a_file.set_accession(accession)
-                out_string = "insert into file (filepath,accession," + \
-                             "mimetype,size,checksum) values (" + \
-                             "\"{path}\",\"{accession}\",\"{mimetype}\"". \
-                             format(path = a_file.filepath,
-                                    accession = a_file.get_accession(),
-                                    mimetype = a_file.get_file_mime_type()) + \
-                                    ",{filesize},\"{filehash}\");\n". \
-                                    format(filesize = a_file.get_file_size(),
-                                           filehash = a_file.get_hash())
-                stdout.write(out_string)
-            else:
-                logger.error("{path} could not be read". \
-                             format(path=a_file.filepath))
-        stdout.write("commit;\n")
+        items = b.get_items()
+        if args.database:
+            db, File = open_file_table(args.database)
+            changed = set()
+            if args.incremental:
+                try:
+                    if add_state_columns(db, File):
+                        db, File = open_file_table(args.database)
+                except Exception as e:
+                    # Without them changes are only noticed by size and
+                    # deleted files are never flagged
+                    logger.error("The file table has no mtime and deleted " \
+                                 "columns and they couldn't be added " \
+                                 "({error}), so --incremental can't be " \
+                                 "used".format(error=e))
+                    return 1
+                known, flagged = known_files(db, File, args.directory_path)
+                items = changed_items(items, known, changed,
+                                      'mtime' in File.__table__.c)
+            rows = index_rows(items, args.io_workers, args.hash_workers)
+            load_database(rows, db, File, args.batch_size, changed)
+            if args.incremental:
+                mark_deleted(db, File, known, flagged, args.batch_size)
+            return 0
+        rows = index_rows(items, args.io_workers, args.hash_workers)
+        if args.format == 'csv':
+            write_csv(rows, stdout)
+        else:
+            write_sql(rows, stdout)
         return 0 
     except KeyboardInterrupt:
         logger.warn("Program aborted manually")
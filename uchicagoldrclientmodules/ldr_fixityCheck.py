@@ -21,7 +21,8 @@ from logging import DEBUG, FileHandler, Formatter, getLogger, \
     INFO, StreamHandler
 from os import _exit, stat
 from os.path import exists
-from sqlalchemy import func, or_, and_, Table
+from random import getrandbits
+from sqlalchemy import or_, and_, Index, Table
 
 from batch import Batch
 from database import Database
@@ -34,8 +35,108 @@ class dbBeforeTables(Action):
         else:
             setattr(namespace,self.dest,value)    
 
-            
-            
+
+def parse_size(value):
+    # a byte count, optionally with a K, M, G or T suffix
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def keyset_sample(db, File, receipt, due, page_size=500):
+    # Walks an accession's files in checksum order starting from a random
+    # checksum and wrapping round to the start. sha256 digests are evenly
+    # spread, so this is a random sample, but with the index from
+    # ensure_sample_index every page is a range read rather than a sort of
+    # the whole table by random().
+    pivot = '%064x' % getrandbits(256)
+    files = db.session.query(File.accession, File.checksum, File.size,
+                             File.filepath). \
+                filter(File.accession == receipt, due)
+    for part in (File.checksum >= pivot, File.checksum < pivot):
+        last = None
+        while True:
+            page = files.filter(part)
+            if last is not None:
+                page = page.filter(or_(File.checksum > last.checksum,
+                                       and_(File.checksum == last.checksum,
+                                            File.filepath > last.filepath)))
+            page = page.order_by(File.checksum, File.filepath). \
+                       limit(page_size).all()
+            for row in page:
+                yield row
+            if len(page) < page_size:
+                break
+            last = page[-1]
+
+def ensure_sample_index(db, File):
+    # keyset_sample filters on accession and pages in (checksum, filepath)
+    # order, which only this index serves without a scan and a sort. It is
+    # created on first use if the database doesn't have it yet.
+    index = Index('ix_file_accession_checksum_filepath', File.accession,
+                  File.checksum, File.filepath)
+    try:
+        index.create(db.session.get_bind(), checkfirst=True)
+    except Exception as e:
+        logger.warning("Couldn't create the {name} index, sampling will " \
+                       "scan the file table ({error})". \
+                       format(name=index.name, error=e))
+
+def sample_files(db, File, receipts, due, numfiles=None, budget=None,
+                 lookahead=1000):
+    # Every accession gets an even share of what is left of the file count
+    # and/or byte budget, so unused shares roll on to the next ones, and
+    # the accessions checked longest ago come first. A file too large for
+    # the share is logged and skipped rather than ending the accession, up
+    # to lookahead of them in a row, so one large file can't take the
+    # budget meant for the accessions after it
+    selected = []
+    files_left = numfiles
+    bytes_left = budget
+    for position, receipt in enumerate(receipts):
+        accessions_left = len(receipts) - position
+        files_share = None
+        bytes_share = None
+        if files_left is not None:
+            files_share = -(-files_left // accessions_left)
+        if bytes_left is not None:
+            bytes_share = bytes_left // accessions_left
+        files_taken = 0
+        bytes_taken = 0
+        skipped = 0
+        for row in keyset_sample(db, File, receipt, due):
+            if files_share is not None and files_taken >= files_share:
+                break
+            if bytes_share is not None and files_taken and \
+                    bytes_taken >= bytes_share:
+                break
+            size = int(row.size or 0)
+            if bytes_share is not None and bytes_taken + size > bytes_share:
+                if size > bytes_share:
+                    logger.info("{path} ({size} bytes) is larger than the " \
+                                "budget share of {receipt}, skipping it". \
+                                format(path=row.filepath, size=size,
+                                       receipt=receipt))
+                skipped += 1
+                if skipped >= lookahead:
+                    break
+                continue
+            skipped = 0
+            selected.append(row)
+            files_taken += 1
+            bytes_taken += size
+        if files_left is not None:
+            files_left -= files_taken
+        if bytes_left is not None:
+            bytes_left -= bytes_taken
+        if files_left == 0 or bytes_left == 0:
+            break
+    logger.info("{count} files ({size} bytes) selected for checking". \
+                format(count=len(selected),
+                       size=sum(int(row.size or 0) for row in selected)))
+    return selected
+
 def main():
     def find_group_name(filepath):
         unix_stat_of_file = stat(fp)
@@ -87,8 +188,14 @@ def main():
                         action="store")
     parser.add_argument("numfiles",help="Enter the number of files you " + \
                         "want to check in this iteration.",action="store",
-                        type=int)
+                        type=int,nargs="?")
+    parser.add_argument("--budget",help="Enter how many bytes to check " + \
+                        "in this iteration, e.g. 500G, instead of or as " + \
+                        "well as a number of files",
+                        action="store",type=parse_size)
     args = parser.parse_args()
+    if args.from_db and args.numfiles is None and args.budget is None:
+        parser.error("Selecting from_db needs numfiles or --budget")
     log_format = Formatter( \
                             "[%(levelname)s] %(asctime)s  " + \
                             "= %(message)s",
@@ -123,24 +230,23 @@ def main():
             
         class File(db.base):
             __table__ = Table('file', db.metadata, autoload=True)        
-        accessions_to_check  = db.session.query(Record). \
-                                   filter(or_(Record.lastFixityCheck == None,
-                                          Record.lastFixityCheck \
-                                              <= isof_sixty_days_ago_date,
-                                          Record.fixityCheckCompleteness \
-                                              == 'incompleted',
-                                          Record.fixityCheckCompleteness \
-                                              == None)).subquery()
-        files_to_check = db.session.query(File.accession,
-                                          File.checksum,
-                                          File.size,
-                                          File.filepath). \
-                            filter(File.accession== \
-                                   accessions_to_check.c.receipt,
-                               or_(File.lastFixityCheck == None,
-                                   File.lastFixityCheck \
-                                       <= isof_sixty_days_ago_date)). \
-                                       order_by(func.random()).limit(args.numfiles)
+        receipts = [row.receipt for row in
+                    db.session.query(Record.receipt). \
+                        filter(or_(Record.lastFixityCheck == None,
+                                   Record.lastFixityCheck \
+                                       <= isof_sixty_days_ago_date,
+                                   Record.fixityCheckCompleteness \
+                                       == 'incompleted',
+                                   Record.fixityCheckCompleteness \
+                                       == None)). \
+                        order_by(Record.lastFixityCheck != None,
+                                 Record.lastFixityCheck)]
+        due = or_(File.lastFixityCheck == None,
+                  File.lastFixityCheck <= isof_sixty_days_ago_date)
+        ensure_sample_index(db, File)
+        files_to_check = sample_files(db, File, receipts, due,
+                                      numfiles = args.numfiles,
+                                      budget = args.budget)
         b = Batch(args.root, query = files_to_check)
         generated_output = b.find_items(from_db = True)
     else:
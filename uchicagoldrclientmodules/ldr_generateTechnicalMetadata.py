@@ -11,16 +11,227 @@ This module is meant to take a batch of files (probably an accession in place) a
 """
 
 from argparse import ArgumentParser
+from datetime import datetime
+from grp import getgrgid
 from logging import DEBUG, FileHandler, Formatter, getLogger, \
     INFO, StreamHandler
-from os import _exit
-from os.path import join, exists, abspath
+from os import _exit, link, replace, stat, walk
+from os.path import join, exists, abspath, basename, getsize
+from pwd import getpwuid
+from shutil import rmtree
+from stat import S_IMODE, S_ISBLK, S_ISCHR, S_ISDIR, S_ISFIFO, S_ISLNK, \
+    S_ISREG, S_ISSOCK, filemode
 from subprocess import TimeoutExpired
+from tempfile import mkdtemp
+from xml.etree.ElementTree import ParseError, fromstring
+from xml.sax.saxutils import escape
 
-from uchicagoldr.batch import Batch
 from uchicagoldr.item import Item
 from uchicagoldr.bash_cmd import BashCommand
 
+from stagingFixity import hashFile, orderedMap
+
+try:
+    import magic
+except ImportError:
+    magic = None
+
+def generateTechnicalMetadata(item, fitscommand, timeout):
+    logger.info("Attempting technical metadata generation for: "+item.get_file_path())
+    fitsArgs=[fitscommand,'-i',item.get_file_path(),'-o',item.get_file_path()+'.fits.xml']
+    fitsCommand=BashCommand(fitsArgs)
+    fitsCommand.set_timeout(timeout)
+    try:
+        logger.info("Attempting FITS generation for: "+item.get_file_path())
+        result=fitsCommand.run_command()
+        if isinstance(result[1],Exception):
+            raise result[1]
+        assert(exists(item.get_file_path()+'.fits.xml'))
+        logger.info("FITS generated for: "+item.get_file_path())
+    except TimeoutExpired:
+        logger.warn("FITS generation timed out")
+        logger.info("Attempting STIF generation")
+        with open(item.get_file_path()+'.stif.txt','w') as f:
+            f.write(generateStif(item.get_file_path(),timeout))
+        assert(exists(item.get_file_path()+'.stif.txt'))
+        logger.info("STIF generated for: "+item.get_file_path())
+    item.find_technical_metadata()
+    assert(item.has_technical_md)
+    logger.info("Technical metadata generation complete for: "+item.get_file_path())
+
+def fileType(statResult):
+    # The names stat's %F gives each kind of file
+    mode=statResult.st_mode
+    if S_ISREG(mode):
+        return "regular empty file" if statResult.st_size == 0 else "regular file"
+    for test,name in ((S_ISDIR,"directory"),(S_ISLNK,"symbolic link"),
+                      (S_ISFIFO,"fifo"),(S_ISSOCK,"socket"),
+                      (S_ISCHR,"character special file"),
+                      (S_ISBLK,"block special file")):
+        if test(mode):
+            return name
+    return "weird file"
+
+def describeStat(path):
+    # Laid out like the stat utility's output, which the STIF used to hold
+    statResult=stat(path)
+    try:
+        owner=getpwuid(statResult.st_uid).pw_name
+    except KeyError:
+        owner='UNKNOWN'
+    try:
+        group=getgrgid(statResult.st_gid).gr_name
+    except KeyError:
+        group='UNKNOWN'
+    def timestamp(nanoseconds):
+        seconds,fraction=divmod(nanoseconds,1000000000)
+        moment=datetime.fromtimestamp(seconds).astimezone()
+        return moment.strftime("%Y-%m-%d %H:%M:%S")+"."+str(fraction).zfill(9)+moment.strftime(" %z")
+    birth="-"
+    if hasattr(statResult,'st_birthtime_ns'):
+        birth=timestamp(statResult.st_birthtime_ns)
+    return "  File: "+path+"\n"+ \
+        "  Size: "+str(statResult.st_size).ljust(10)+"\tBlocks: "+str(statResult.st_blocks).ljust(10)+ \
+        " IO Block: "+str(statResult.st_blksize).ljust(6)+" "+fileType(statResult)+"\n"+ \
+        "Device: "+format(statResult.st_dev,'x')+"h/"+str(statResult.st_dev)+"d\tInode: "+str(statResult.st_ino).ljust(11)+ \
+        " Links: "+str(statResult.st_nlink)+"\n"+ \
+        "Access: ("+oct(S_IMODE(statResult.st_mode))[2:].zfill(4)+"/"+filemode(statResult.st_mode)+")"+ \
+        "  Uid: ("+str(statResult.st_uid).rjust(5)+"/"+owner.rjust(8)+")   Gid: ("+str(statResult.st_gid).rjust(5)+"/"+group.rjust(8)+")\n"+ \
+        "Access: "+timestamp(statResult.st_atime_ns)+"\n"+ \
+        "Modify: "+timestamp(statResult.st_mtime_ns)+"\n"+ \
+        "Change: "+timestamp(statResult.st_ctime_ns)+"\n"+ \
+        " Birth: "+birth+"\n"
+
+def describeType(path, timeout):
+    # The equivalent of file -i and file, from libmagic when python-magic is
+    # installed and from the file utility otherwise
+    if magic is not None:
+        mimeType=magic.from_file(path,mime=True)
+        encoding=magic.Magic(mime_encoding=True).from_file(path)
+        return path+": "+mimeType+"; charset="+encoding+"\n"+ \
+            path+": "+magic.from_file(path)+"\n"
+    mimeCommand=BashCommand(['file','-i',path])
+    mimeCommand.set_timeout(timeout)
+    fileCommand=BashCommand(['file',path])
+    fileCommand.set_timeout(timeout)
+    assert(mimeCommand.run_command()[0])
+    assert(fileCommand.run_command()[0])
+    return mimeCommand.get_data()[1].stdout.decode(encoding='UTF-8')+ \
+        fileCommand.get_data()[1].stdout.decode(encoding='UTF-8')
+
+def generateStif(path, timeout):
+    # This is only reached for the files too big for FITS, so the file is
+    # read once for both digests
+    sha256Hash,md5Hash=hashFile(path)
+    return describeStat(path)+ \
+        describeType(path,timeout)+ \
+        "md5: "+md5Hash+'\n'+ \
+        "sha256: "+sha256Hash
+
+def needsTechnicalMetadata(directory, root):
+    # A file's sidecars sit next to it, so each directory's listing is
+    # enough to tell whether its files have already been described, without
+    # file system probes and without listing the whole tree up front
+    described=0
+    for dirPath,dirNames,fileNames in walk(directory):
+        sidecars=set(fileName for fileName in fileNames
+                     if ".fits.xml" in fileName or ".stif.txt" in fileName)
+        for fileName in fileNames:
+            if fileName in sidecars:
+                continue
+            path=join(dirPath,fileName)
+            if fileName+'.fits.xml' in sidecars or fileName+'.stif.txt' in sidecars:
+                described+=1
+                logger.debug(path+" already has technical metadata. Continuing.")
+                continue
+            yield Item(path,root)
+    logger.info(str(described)+" files already have technical metadata")
+
+def fitsBatches(items, batchSize):
+    # FITS names its output after the input file name, so a batch never
+    # holds two files with the same name
+    batch=[]
+    names=set()
+    for item in items:
+        name=basename(item.get_file_path())
+        if len(batch) >= batchSize or name in names:
+            yield batch
+            batch=[]
+            names=set()
+        batch.append(item)
+        names.add(name)
+    if batch:
+        yield batch
+
+def batchTimeout(batch, timeout, perFile, perGB):
+    # A batch run has to get through every file in it, so it is allowed the
+    # single file timeout plus an allowance for each file and gigabyte
+    size=sum(getsize(item.get_file_path()) for item in batch)
+    return timeout+perFile*len(batch)+perGB*size/(1024*1024*1024)
+
+def generateBatchFits(batch, fitscommand, timeout):
+    # One FITS run, and so one JVM start, for the whole batch. The files are
+    # hard linked into a scratch directory for FITS to work through, since
+    # its tools would describe a symlink rather than the file. Anything
+    # that didn't get output is returned, to be done file by file.
+    if len(batch) == 1:
+        return batch
+    inputDir=mkdtemp(prefix='fitsBatch')
+    outputDir=mkdtemp(prefix='fitsBatchOut')
+    try:
+        try:
+            for item in batch:
+                link(item.get_file_path(),join(inputDir,basename(item.get_file_path())))
+        except OSError as e:
+            # Most likely the scratch directory is on another device
+            logger.warn("Couldn't link the batch for FITS ("+str(e)+"), falling back to single files")
+            return batch
+        logger.info("Attempting FITS generation for a batch of "+str(len(batch))+" files")
+        fitsCommand=BashCommand([fitscommand,'-i',inputDir,'-o',outputDir])
+        fitsCommand.set_timeout(timeout)
+        result=fitsCommand.run_command()
+        # A run that failed or was killed may have left truncated output, so
+        # none of it is trusted
+        failure=None
+        if not result[0] or isinstance(result[1],Exception):
+            failure=str(result[1])
+        elif result[1].returncode != 0:
+            failure="exit status "+str(result[1].returncode)
+        if failure is not None:
+            logger.warn("FITS batch generation failed ("+failure+"), falling back to single files")
+            return batch
+        leftovers=[]
+        for item in batch:
+            name=basename(item.get_file_path())
+            output=join(outputDir,name+'.fits.xml')
+            if not exists(output):
+                leftovers.append(item)
+                continue
+            # FITS records the path it was given, which was the link
+            with open(output,'r',encoding='utf-8') as f:
+                fitsXml=f.read().replace(escape(join(inputDir,name)),escape(item.get_file_path()))
+            try:
+                fromstring(fitsXml)
+            except ParseError:
+                logger.warn("FITS batch output for "+item.get_file_path()+" isn't well formed, it will be done on its own")
+                leftovers.append(item)
+                continue
+            with open(item.get_file_path()+'.fits.xml.tmp','w',encoding='utf-8') as f:
+                f.write(fitsXml)
+            replace(item.get_file_path()+'.fits.xml.tmp',item.get_file_path()+'.fits.xml')
+            logger.info("FITS generated for: "+item.get_file_path())
+            item.find_technical_metadata()
+            assert(item.has_technical_md)
+            logger.info("Technical metadata generation complete for: "+item.get_file_path())
+        return leftovers
+    finally:
+        rmtree(inputDir,ignore_errors=True)
+        rmtree(outputDir,ignore_errors=True)
+
+def generateForBatch(batch, fitscommand, timeout, perFile=0, perGB=0):
+    for item in generateBatchFits(batch,fitscommand,batchTimeout(batch,timeout,perFile,perGB)):
+        generateTechnicalMetadata(item,fitscommand,timeout)
+
 def main():
     # start of parser boilerplate
     parser = ArgumentParser(description="This module is meant to take a batch of files (probably an accession in place) and generate the technical metadata for it.",
@@ -55,6 +266,22 @@ def main():
                          '-t','--timeout',help="set a timeout in seconds for any single bash command",
                          dest='timeout',default=3600,type=int \
     )
+    parser.add_argument( \
+                         '--batch-size',help="set how many files a single FITS run describes",
+                         dest='batch_size',default=50,type=int \
+    )
+    parser.add_argument( \
+                         '--batch-file-timeout',help="set how many seconds a FITS batch is allowed for each file in it, on top of the timeout",
+                         dest='batch_file_timeout',default=60,type=int \
+    )
+    parser.add_argument( \
+                         '--batch-gb-timeout',help="set how many seconds a FITS batch is allowed for each GB in it, on top of the timeout",
+                         dest='batch_gb_timeout',default=600,type=int \
+    )
+    parser.add_argument( \
+                         '--workers',help="set how many FITS runs go at once",
+                         dest='workers',default=1,type=int \
+    )
     parser.add_argument("item", help="Enter a noid for an accession or a " + \
                         "directory path that you need to validate against" + \
                         " a type of controlled collection"
@@ -83,63 +310,14 @@ def main():
         logger.addHandler(fh)
     try:
         fitscommand="fits"
-        md5command="md5"
-        shacommand="sha256"
 
-        b = Batch(abspath(args.root), abspath(args.item))
-        for item in b.find_items(from_directory=True):
-            if ".fits.xml" in item.find_file_name() or ".stif.txt" in item.find_file_name():
-                continue
-            item.find_technical_metadata()
-            if item.has_technical_md:
-                logger.info(item.get_file_path()+" already has technical metadata. Continuing.")
-                continue
-            else:
-                logger.info("Attempting technical metadata generation for: "+item.get_file_path())
-                fitsArgs=[fitscommand,'-i',item.get_file_path(),'-o',item.get_file_path()+'.fits.xml']
-                fitsCommand=BashCommand(fitsArgs)
-                fitsCommand.set_timeout(args.timeout)
-                try:
-                    logger.info("Attempting FITS generation for: "+item.get_file_path())
-                    result=fitsCommand.run_command()
-                    if isinstance(result[1],Exception):
-                        raise result[1]
-                    assert(exists(item.get_file_path()+'.fits.xml'))
-                    logger.info("FITS generated for: "+item.get_file_path()) 
-                except TimeoutExpired:
-                    logger.warn("FITS generation timed out")
-                    logger.info("Attempting STIF generation")
-                    statArgs=['stat',item.get_file_path()]
-                    statCommand=BashCommand(statArgs)
-                    statCommand.set_timeout(args.timeout)
-
-                    mimeArgs=['file','-i',item.get_file_path()]
-                    mimeCommand=BashCommand(mimeArgs)
-                    mimeCommand.set_timeout(args.timeout)
-
-                    fileArgs=['file',item.get_file_path()]
-                    fileCommand=BashCommand(fileArgs)
-                    fileCommand.set_timeout(args.timeout)
-                    
-                    assert(statCommand.run_command()[0])
-                    assert(mimeCommand.run_command()[0])
-                    assert(fileCommand.run_command()[0])
-
-                    md5hash=item.find_md5_hash()
-                    shahash=item.find_sha256_hash
-
-                    with open(item.get_file_path()+'.stif.txt','w') as f:
-                        f.write(statCommand.get_data()[1].stdout.decode(encoding='UTF-8')+ \
-                                mimeCommand.get_data()[1].stdout.decode(encoding='UTF-8')+ \
-                                fileCommand.get_data()[1].stdout.decode(encoding='UTF-8')+ \
-                                "md5: " + item.find_md5_hash() + '\n'+ \
-                                "sha256: " + item.find_sha256_hash() \
-                               )
-                    assert(exists(item.get_file_path()+'.stif.txt'))
-                    logger.info("STIF generated for: "+item.get_file_path())
-                item.find_technical_metadata()
-                assert(item.has_technical_md)
-                logger.info("Technical metadata generation complete for: "+item.get_file_path())
+        # Batches are independent FITS runs, so several can go at once. Only a
+        # few batches are queued ahead of the workers, and the tree is walked
+        # as they are, so a large accession isn't listed into memory up front.
+        for batchResult in orderedMap(lambda batch: generateForBatch(batch,fitscommand,args.timeout,args.batch_file_timeout,args.batch_gb_timeout),
+                                      fitsBatches(needsTechnicalMetadata(abspath(args.item),abspath(args.root)),args.batch_size),
+                                      args.workers):
+            pass
         return 0
     except KeyboardInterrupt:
         logger.error("Program aborted manually")
@@ -3,8 +3,7 @@
 # Default package imports begin #
 from argparse import ArgumentParser
 from os import _exit
-from os.path import split, exists, dirname, realpath
-from re import match
+from os.path import split, exists, join
 # Default package imports end #
 
 # Third party package imports begin #
@@ -17,7 +16,12 @@ from uchicagoldrLogging.handlers import DefaultTermHandler, DebugTermHandler, \
     DefaultFileHandlerAtLevel
 from uchicagoldrLogging.filters import UserAndIPFilter
 
-from uchicagoldr.bash_cmd import BashCommand
+from stagingPipeline import PipelineResult, StagingError, resolveStagingRoot
+from ldr_staging_moveFiles import prepareDestination, transferFiles, \
+    copyHashFiles, addTransferArguments, rsyncOptionsFromArgs
+from ldr_staging_originHash import originHash
+from ldr_staging_stagingHash import stagingHash
+from ldr_staging_audit import audit
 # Local package imports end #
 
 # Header info begins #
@@ -36,6 +40,50 @@ and generating original fixity/administrative information.
 """
 
 # Functions begin #
+def runStage(stage, func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    except StagingError:
+        raise
+    except Exception as e:
+        raise StagingError(stage, "Exception ("+str(e)+")")
+
+
+def runStagingPipeline(item, root, dest_root, prefix, logger, rehash=False,
+                       transfer='rsync', workers=1, paranoid=False,
+                       index=False, rsyncOptions=None, streams=1):
+    if item[-1] == "/" and item != root:
+        raise StagingError('moveFiles',
+                           "Root appears to not conform to rsync path specs.")
+    stageRoot = resolveStagingRoot(dest_root, 'moveFiles')
+    folders = runStage('moveFiles', prepareDestination,
+                       stageRoot, prefix, logger)
+
+    stagingDebugLog = DebugFileHandler(join(folders.adminFolder, 'log.txt'))
+    logger.addHandler(stagingDebugLog)
+    try:
+        if transfer == 'copyhash':
+            # Both fixity logs are produced by the copy itself
+            originHashes, stagedHashes = runStage('moveFiles', copyHashFiles,
+                                                  item, root, folders, logger,
+                                                  rehash=rehash, index=index)
+        else:
+            runStage('moveFiles', transferFiles, item, folders, logger,
+                     options=rsyncOptions, streams=streams)
+            originHashes = runStage('originHash', originHash,
+                                    item, root, folders, logger,
+                                    rehash=rehash, workers=workers,
+                                    paranoid=paranoid, index=index)
+            stagedHashes = runStage('stagingHash', stagingHash,
+                                    folders, logger, rehash=rehash,
+                                    workers=workers, paranoid=paranoid,
+                                    index=index)
+        auditResult = runStage('audit', audit,
+                               originHashes, stagedHashes, logger,
+                               join(folders.adminFolder, 'auditReport.jsonl'))
+    finally:
+        logger.removeHandler(stagingDebugLog)
+    return PipelineResult(folders, originHashes, stagedHashes, auditResult)
 # Functions end #
 
 
@@ -119,9 +167,38 @@ def main():
                         "hashes, recreate them on this run",
                         action="store_true"
     )
+    parser.add_argument(
+                        "--transfer",
+                        help="How to move the files: rsync, or copyhash " +
+                        "to read each file once while hashing it",
+                        choices=['rsync', 'copyhash'],
+                        default='rsync',
+                        action="store"
+    )
+    parser.add_argument(
+                        "--paranoid",
+                        help="Ignore the hash cache and read every file " +
+                        "that needs hashing",
+                        action="store_true"
+    )
+    addTransferArguments(parser)
+    parser.add_argument(
+                        "--index",
+                        help="Also write compact binary indexes of the " +
+                        "fixity logs",
+                        action="store_true"
+    )
+    parser.add_argument(
+                        "--workers",
+                        help="The number of files to hash concurrently",
+                        type=int,
+                        default=1,
+                        action="store"
+    )
     parser.add_argument(
                         "--scriptloc",
-                        help="Specify and alternate script location",
+                        help="Ignored, the staging stages now run " +
+                        "in this process",
                         action="store"
     )
     try:
@@ -169,72 +246,24 @@ def main():
     # End user specified log instantiation #
     try:
         # Begin module code #
-        pythonPath = 'python3'
-        if not args.scriptloc:
-            scriptsLoc = dirname(realpath(__file__))+"/"
-        else:
-            scriptsLoc = args.scriptloc
-
-        appendArgs = []
-        if args.rehash:
-            appendArgs.append('--rehash')
-        if args.verbosity:
-            appendArgs.append('-b')
-            appendArgs.append(args.verbosity)
-
-        mvArgs = [pythonPath, scriptsLoc+'ldr_staging_moveFiles.py',
-                  args.item, args.root, args.dest_root, args.prefix, "--chain"]
-        mvArgs = mvArgs+appendArgs
-        mvCommand = BashCommand(mvArgs)
-        assert(mvCommand.run_command()[0])
-        print("\n".join(mvCommand.get_data()[1].stdout.split('\n')))
-        for line in mvCommand.get_data()[1].stdout.split('\n'):
-            if match('^\[CRITICAL\]', line):
-                print("Critical error detected. Exiting")
-                exit(1)
-
-        with open('/tmp/folderName.txt', 'r') as f:
-            try:
-                folder = f.read()
-            except Exception as e:
-                logger.critical("ENDS: Failure in reading chain file in tmp. " +
-                                "({})".format(e))
-
-        origHashArgs = [pythonPath, scriptsLoc+'ldr_staging_originHash.py',
-                        args.item, args.root, args.dest_root, folder]
-        origHashArgs = origHashArgs+appendArgs
-        origHashCommand = BashCommand(origHashArgs)
-        assert(origHashCommand.run_command()[0])
-        print("\n".join(origHashCommand.get_data()[1].stdout.split('\n')))
-        for line in origHashCommand.get_data()[1].stdout.split('\n'):
-            if match('^\[CRITICAL\]', line):
-                print("Critical error detected. Exiting")
-                exit(1)
-
-        stageHashArgs = [pythonPath, scriptsLoc+'ldr_staging_stagingHash.py',
-                         args.dest_root, folder]
-        stageHashArgs = stageHashArgs+appendArgs
-        stageHashCommand = BashCommand(stageHashArgs)
-        assert(stageHashCommand.run_command()[0])
-        print("\n".join(stageHashCommand.get_data()[1].stdout.split('\n')))
-        for line in stageHashCommand.get_data()[1].stdout.split('\n'):
-            if match('^\[CRITICAL\]', line):
-                print("Critical error detected. Exiting")
-                exit(1)
-
-        auditArgs = [pythonPath, scriptsLoc+'ldr_staging_audit.py',
-                     args.dest_root, folder]
-        auditArgs = auditArgs+appendArgs
-        auditCommand = BashCommand(auditArgs)
-        assert(auditCommand.run_command()[0])
-        print("\n".join(auditCommand.get_data()[1].stdout.split('\n')))
-        for line in auditCommand.get_data()[1].stdout.split('\n'):
-            if match('^\[CRITICAL\]', line):
-                print("Critical error detected. Exiting")
-                exit(1)
+        if args.scriptloc:
+            logger.warn("--scriptloc is no longer used, ignoring it.")
+        result = runStagingPipeline(args.item, args.root, args.dest_root,
+                                    args.prefix, logger, rehash=args.rehash,
+                                    transfer=args.transfer,
+                                    workers=args.workers,
+                                    paranoid=args.paranoid,
+                                    index=args.index,
+                                    rsyncOptions=rsyncOptionsFromArgs(args),
+                                    streams=args.streams)
+        logger.info("Staged into "+result.folders.folder)
         # End module code #
         logger.info("ENDS: COMPLETE")
         return 0
+    except StagingError as e:
+        logger.critical("ENDS: Critical error detected in "+e.stage +
+                        " ("+e.message+")")
+        return 1
     except KeyboardInterrupt:
         logger.error("ENDS: Program aborted manually")
         return 131
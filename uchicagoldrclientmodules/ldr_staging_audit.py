@@ -2,6 +2,8 @@
 
 # Default package imports begin #
 from argparse import ArgumentParser
+from json import dumps
+from logging import DEBUG
 from os import _exit
 from os.path import split, exists, join
 # Default package imports end #
@@ -16,9 +18,9 @@ from uchicagoldrLogging.handlers import DefaultTermHandler, DebugTermHandler, \
     DefaultFileHandlerAtLevel
 from uchicagoldrLogging.filters import UserAndIPFilter
 
-from uchicagoldrStaging.validation.validateBase import ValidateBase
-from uchicagoldrStaging.population.readExistingFixityLog import \
-    ReadExistingFixityLog
+from stagingPipeline import AuditResult, StagingError, resolveStagingRoot, \
+    stagingFolders
+from fixityIndex import openFixityLog, closeFixityLog
 # Local package imports end #
 
 # Header info begins #
@@ -35,6 +37,47 @@ This module audits a populated staging directory.
 """
 
 # Functions begin #
+def audit(existingOriginalFileHashes, existingMovedFileHashes, logger,
+          report):
+    # A single pass over each side with lookups on the other. Every
+    # classification is streamed straight into the report rather than
+    # collected, and either side may be a memory mapped fixity index.
+    counts = {'GOOD': 0, 'NOT MOVED': 0, 'BAD HASH': 0, 'FOREIGN FILE': 0}
+    debugging = logger.isEnabledFor(DEBUG)
+
+    with open(report, 'w') as f:
+        def record(status, entry, originHash, movedHash):
+            counts[status] += 1
+            f.write(dumps({'status': status, 'path': entry,
+                           'origin': originHash, 'staged': movedHash}) + '\n')
+            if debugging:
+                logger.debug(status+": "+entry+":" +
+                             str(originHash if originHash else movedHash))
+
+        for entry, originHash in existingOriginalFileHashes.items():
+            movedHash = existingMovedFileHashes.get(entry)
+            if movedHash is None:
+                record('NOT MOVED', entry, originHash, None)
+            elif originHash != movedHash:
+                record('BAD HASH', entry, originHash, movedHash)
+            else:
+                record('GOOD', entry, originHash, movedHash)
+        for entry, movedHash in existingMovedFileHashes.items():
+            if entry not in existingOriginalFileHashes:
+                record('FOREIGN FILE', entry, None, movedHash)
+
+    logger.info(str(len(existingMovedFileHashes)) +
+                " file(s) total in the staging area.")
+    logger.info(str(counts['NOT MOVED']) +
+                " file(s) not copied.")
+    logger.info(str(counts['BAD HASH']) +
+                " file(s) have a different hash from the origin.")
+    logger.info(str(counts['FOREIGN FILE']) +
+                " file(s) appear to not have come from the origin.")
+    logger.info("Audit report written to "+report)
+    return AuditResult(counts['GOOD'], counts['NOT MOVED'],
+                       counts['BAD HASH'], counts['FOREIGN FILE'],
+                       len(existingMovedFileHashes), report)
 # Functions end #
 
 
@@ -103,6 +146,12 @@ def main():
                         " hashes, recreate them on this run",
                         action="store_true"
     )
+    parser.add_argument(
+                        "--report",
+                        help="Where to write the JSON lines audit report, " +
+                        "defaults to auditReport.jsonl in the admin folder",
+                        action="store"
+    )
     try:
         args = parser.parse_args()
     except SystemExit:
@@ -149,66 +198,32 @@ def main():
     try:
         logger.info("BEGINS")
         # Begin module code #
-        validation = ValidateBase(args.dest_root)
-        if validation[0] != True:
-            logger.critical("Your staging root isn't valid!")
-            exit(1)
-        else:
-            stageRoot = join(*validation[1:])
-        destinationAdminRoot = join(stageRoot, 'admin/')
-        containing_folder = args.containing_folder
-        destinationAdminFolder = join(destinationAdminRoot, containing_folder)
+        stageRoot = resolveStagingRoot(args.dest_root, 'audit')
+        folders = stagingFolders(stageRoot, args.containing_folder)
 
         stagingDebugLog = DebugFileHandler(
-            join(destinationAdminFolder, 'log.txt')
+            join(folders.adminFolder, 'log.txt')
         )
         logger.addHandler(stagingDebugLog)
 
-        existingOriginalFileHashes = ReadExistingFixityLog(
-                                         join(
-                                           destinationAdminFolder,
-                                           'fixityFromOrigin.txt'
-                                         )
-                                     )
-        existingMovedFileHashes = ReadExistingFixityLog(
-                                     join(
-                                       destinationAdminFolder,
-                                       'fixityOnDisk.txt'
-                                     )
-                                  )
-
-        notMoved = [key for key in existingOriginalFileHashes
-                    if key not in existingMovedFileHashes]
-        foreignFiles = [key for key in existingMovedFileHashes
-                        if key not in existingOriginalFileHashes]
-        badHash = [key for key in existingOriginalFileHashes
-                   if key not in notMoved and
-                   existingOriginalFileHashes[key] != existingMovedFileHashes[key]]
-
-        for entry in existingOriginalFileHashes:
-            if entry not in notMoved and entry not in badHash:
-                logger.debug("GOOD: "+entry+":" +
-                             str(existingOriginalFileHashes[entry]))
-            elif entry in notMoved:
-                logger.debug("NOT MOVED: "+entry+":" +
-                             str(existingOriginalFileHashes[entry]))
-            elif entry in badHash:
-                logger.debug("BAD HASH: "+entry+":" +
-                             str(existingOriginalFileHashes[entry]))
-        for entry in foreignFiles:
-            logger.debug("FOREIGN FILE: "+entry)
-
-        logger.info(str(len(existingMovedFileHashes)) +
-                    " file(s) total in the staging area.")
-        logger.info(str(len(notMoved)) +
-                    " file(s) not copied.")
-        logger.info(str(len(badHash)) +
-                    " file(s) have a different hash from the origin.")
-        logger.info(str(len(foreignFiles)) +
-                    " file(s) appear to not have come from the origin.")
+        report = args.report
+        if not report:
+            report = join(folders.adminFolder, 'auditReport.jsonl')
+        originHashes = openFixityLog(join(folders.adminFolder,
+                                          'fixityFromOrigin.txt'))
+        movedHashes = openFixityLog(join(folders.adminFolder,
+                                         'fixityOnDisk.txt'))
+        try:
+            audit(originHashes, movedHashes, logger, report)
+        finally:
+            closeFixityLog(originHashes)
+            closeFixityLog(movedHashes)
         # End module code #
         logger.info("ENDS: COMPLETE")
         return 0
+    except StagingError as e:
+        logger.critical("ENDS: "+str(e))
+        return 1
     except KeyboardInterrupt:
         logger.error("ENDS: Program aborted manually")
         return 131
@@ -2,8 +2,16 @@
 
 # Default package imports begin #
 from argparse import ArgumentParser
-from os import _exit
-from os.path import split, exists, join, isdir
+from concurrent.futures import ThreadPoolExecutor
+from heapq import heappop, heappush
+from os import _exit, walk, makedirs, readlink, symlink, stat, lstat, \
+    scandir, mkdir, replace, getpid, rmdir
+from os.path import split, exists, join, isdir, islink, basename, relpath, \
+    getsize, normpath, dirname, lexists
+from shutil import copystat
+from re import search
+from subprocess import Popen, PIPE, STDOUT, CompletedProcess
+from time import time
 # Default package imports end #
 
 # Third party package imports begin #
@@ -16,10 +24,11 @@ from uchicagoldrLogging.handlers import DefaultTermHandler, DebugTermHandler, \
     DefaultFileHandlerAtLevel
 from uchicagoldrLogging.filters import UserAndIPFilter
 
-from uchicagoldr.bash_cmd import BashCommand
-
-from uchicagoldrStaging.validation.validateBase import ValidateBase
 from uchicagoldrStaging.population.prefixToFolder import prefixToFolder
+
+from stagingPipeline import StagingError, resolveStagingRoot, stagingFolders
+from stagingFixity import HashCache, copyAndHashFile, fixityLogLine
+from fixityIndex import indexPathFor, readFixityLog, writeFixityIndex
 # Local package imports end #
 
 # Header info begins #
@@ -37,6 +46,413 @@ and move it into disk space in the LDR staging area.
 """
 
 # Functions begin #
+# Prefixes the lines rsync prints for each file it has transferred. The
+# format has to include a transfer statistic (%b, the bytes sent), which
+# makes rsync print the line once the file is done rather than as it starts.
+journalMarker = "transferred: "
+journalFormat = journalMarker+"%b %n"
+
+# The base rsync options for each kind of transfer. Local disk to disk
+# copies neither compress nor compute deltas, both of which only cost CPU
+# when there is no network in between.
+transferProfiles = {
+    'local': ['-av', '--whole-file'],
+    'remote': ['-avz'],
+}
+
+
+def rsyncOptions(item, profile='auto', compress=None, delta=None,
+                 inplace=False, sparse=False):
+    if profile == 'auto':
+        # rsync's own test for a remote source: a host before the first
+        # colon, and no slash ahead of it
+        remote = ':' in item and '/' not in item.split(':', 1)[0]
+        profile = 'remote' if remote else 'local'
+    options = list(transferProfiles[profile])
+    if compress is True and '-avz' not in options:
+        options.append('--compress')
+    if compress is False and '-avz' in options:
+        options[options.index('-avz')] = '-av'
+    if delta is True:
+        options = [x for x in options if x != '--whole-file']
+        options.append('--no-whole-file')
+    if delta is False and '--whole-file' not in options:
+        options.append('--whole-file')
+    if inplace:
+        options.append('--inplace')
+    if sparse:
+        options.append('--sparse')
+    return options
+
+
+def addTransferArguments(parser):
+    parser.add_argument(
+                        "--profile",
+                        help="The kind of transfer this is, which picks " +
+                        "the rsync options. auto treats host:path " +
+                        "sources as remote and anything else as local",
+                        choices=['auto', 'local', 'remote'],
+                        default='auto',
+                        action="store"
+    )
+    parser.add_argument(
+                        "--compress",
+                        help="Compress data in transit, regardless of the " +
+                        "profile",
+                        dest="compress",
+                        default=None,
+                        action="store_true"
+    )
+    parser.add_argument(
+                        "--no-compress",
+                        help="Never compress data in transit",
+                        dest="compress",
+                        action="store_false"
+    )
+    parser.add_argument(
+                        "--delta",
+                        help="Use rsync's delta transfer algorithm " +
+                        "rather than copying whole files",
+                        dest="delta",
+                        default=None,
+                        action="store_true"
+    )
+    parser.add_argument(
+                        "--whole-file",
+                        help="Always copy whole files",
+                        dest="delta",
+                        action="store_false"
+    )
+    parser.add_argument(
+                        "--inplace",
+                        help="Update destination files in place",
+                        action="store_true"
+    )
+    parser.add_argument(
+                        "--sparse",
+                        help="Recreate sparse files as sparse files",
+                        action="store_true"
+    )
+    parser.add_argument(
+                        "--streams",
+                        help="Split the transfer into this many balanced " +
+                        "shards and run an rsync for each concurrently",
+                        type=int,
+                        default=1,
+                        action="store"
+    )
+
+
+def rsyncOptionsFromArgs(args):
+    return rsyncOptions(args.item, profile=args.profile,
+                        compress=args.compress, delta=args.delta,
+                        inplace=args.inplace, sparse=args.sparse)
+
+
+def logThroughput(logger, transferred, seconds):
+    rate = transferred / seconds if seconds > 0 else 0
+    logger.info("Transferred "+str(transferred)+" bytes in " +
+                "{0:.1f}".format(seconds)+" seconds (" +
+                "{0:.2f}".format(rate/(1024*1024))+" MiB/s)")
+
+
+def prepareDestination(stageRoot, prefix, logger):
+    if not prefix[-1].isdigit():
+        # Claim the next numbered folder with mkdir, which fails if another
+        # job on this or any other host got there first, and move on to the
+        # following number when that happens
+        for attempt in range(100):
+            destFolder = prefixToFolder(join(stageRoot, 'data/'), prefix)
+            folders = stagingFolders(stageRoot, destFolder)
+            try:
+                mkdir(folders.dataFolder)
+                break
+            except FileExistsError:
+                logger.debug(folders.folder+" was claimed by another " +
+                             "transfer, trying the next folder")
+        else:
+            raise StagingError('moveFiles',
+                               'Could not claim a new folder for the ' +
+                               'prefix '+prefix)
+        logger.info("Creating new data and admin directories for your " +
+                    "prefix: "+destFolder)
+        try:
+            mkdir(folders.adminFolder)
+        except OSError as e:
+            # Give up the claim, so the next run doesn't skip past the number
+            rmdir(folders.dataFolder)
+            if isinstance(e, FileExistsError):
+                raise StagingError('moveFiles',
+                                   'An admin folder already exists for ' +
+                                   'the new folder '+folders.folder)
+            raise
+
+        assert(isdir(folders.adminFolder))
+        assert(isdir(folders.dataFolder))
+    else:
+        folders = stagingFolders(stageRoot, prefix)
+        logger.info("Attempting to resume transfer into "+folders.folder)
+
+        for folder in [folders.adminFolder, folders.dataFolder]:
+            if not exists(folder):
+                raise StagingError('moveFiles',
+                                   'It looks like you are trying to resume ' +
+                                   'a transfer, but a corresponding data ' +
+                                   'or admin folder is missing! Please ' +
+                                   'remedy this and try again!')
+    return folders
+
+
+def writeChainFile(chainFile, folder):
+    # Write then rename, so a reader never sees a partially written name
+    tempPath = chainFile+'.'+str(getpid())+'.tmp'
+    with open(tempPath, 'w') as f:
+        f.write(folder)
+    replace(tempPath, chainFile)
+
+
+def rsyncSource(item):
+    # The directory rsync names transferred files relative to
+    if item[-1] == "/":
+        return item
+    # A bare relative item has no directory part, so use the current one
+    return (dirname(item) or ".")+"/"
+
+
+def pendingTransfers(item, folders, journal):
+    # Everything in the origin that isn't journaled as transferred, or whose
+    # copy is missing or a different size (a partially written file)
+    sourceBase = rsyncSource(item)
+    if isdir(item):
+        sources = []
+        for dirPath, dirNames, fileNames in walk(item):
+            sources.extend(join(dirPath, name) for name in fileNames)
+            sources.extend(join(dirPath, name) for name in dirNames
+                           if islink(join(dirPath, name)))
+    else:
+        sources = [item]
+    for src in sources:
+        name = relpath(src, sourceBase)
+        dst = join(folders.dataFolder, name)
+        if name in journal and lexists(dst) and \
+                lstat(dst).st_size == lstat(src).st_size:
+            continue
+        yield name
+
+
+def runRsync(rsyncArgs, journalPath, logger):
+    # Stream rsync's output so that every file is journaled as soon as it
+    # has landed, rather than once the whole transfer exits
+    output = []
+    process = Popen(rsyncArgs, stdout=PIPE, stderr=STDOUT,
+                    universal_newlines=True)
+    try:
+        with open(journalPath, 'a') as journal:
+            for line in process.stdout:
+                line = line.rstrip('\n')
+                output.append(line)
+                if line.startswith(journalMarker):
+                    name = line[len(journalMarker):].split(' ', 1)[-1]
+                    if name and name[-1] != "/":
+                        journal.write(name+'\n')
+                        journal.flush()
+        process.wait()
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+    return CompletedProcess(rsyncArgs, process.returncode,
+                            stdout='\n'.join(output))
+
+
+def transferUnits(item, sourceBase):
+    # The top level entries of the item, with the bytes and files under each
+    for entry in scandir(item):
+        size, count = 0, 1
+        if entry.is_dir(follow_symlinks=False):
+            count = 0
+            for dirPath, dirNames, fileNames in walk(entry.path):
+                for name in fileNames:
+                    size += lstat(join(dirPath, name)).st_size
+                count += len(fileNames)
+        else:
+            size = entry.stat(follow_symlinks=False).st_size
+        yield relpath(entry.path, sourceBase), size, count
+
+
+def partitionTransfers(units, streams):
+    # Greedily give the heaviest remaining unit to the lightest shard. Every
+    # file costs a fixed overhead on top of its bytes, so shards of many
+    # small files are balanced against shards of a few large ones.
+    perFileOverhead = 64*1024
+    shards = [[] for x in range(streams)]
+    loads = [(0, x) for x in range(streams)]
+    for name, size, count in sorted(units, key=lambda x: -(x[1] +
+                                                           x[2] *
+                                                           perFileOverhead)):
+        load, shard = heappop(loads)
+        shards[shard].append(name)
+        heappush(loads, (load + size + count*perFileOverhead, shard))
+    return [shard for shard in shards if shard]
+
+
+def transferFiles(item, folders, logger, options=None, streams=1):
+    journalPath = join(folders.adminFolder, 'transferJournal.txt')
+    if options is None:
+        options = rsyncOptions(item)
+    rsyncArgs = ['rsync'] + options + ['--stats',
+                                       '--out-format='+journalFormat]
+    # Sharded transfers name files relative to this, so the unit names, the
+    # file lists and the rsync source must all agree on it
+    sourceBase = rsyncSource(item)
+    units = None
+    if exists(journalPath):
+        with open(journalPath, 'r') as f:
+            journal = set(line.rstrip('\n') for line in f)
+        logger.info("Resuming from the transfer journal, " +
+                    str(len(journal))+" file(s) already transferred")
+        pending = list(pendingTransfers(item, folders, journal))
+        if not pending:
+            logger.info("Nothing left to transfer.")
+            return
+        logger.info(str(len(pending))+" file(s) left to transfer")
+        units = [(name, lstat(join(sourceBase, name)).st_size, 1)
+                 for name in pending]
+    elif streams > 1 and isdir(item):
+        units = list(transferUnits(item, sourceBase))
+
+    if units:
+        shards = partitionTransfers(units, max(streams, 1))
+        commands = []
+        for number, shard in enumerate(shards):
+            listPath = join(folders.adminFolder,
+                            'transferPending.txt' if len(shards) == 1 else
+                            'transferPending'+str(number)+'.txt')
+            with open(listPath, 'w') as f:
+                for name in shard:
+                    f.write(name+'\n')
+            # --files-from turns off the recursion -a implies
+            commands.append(rsyncArgs + ['-r', '--files-from='+listPath,
+                                         sourceBase, folders.dataFolder])
+    else:
+        commands = [rsyncArgs + [item, folders.dataFolder]]
+
+    logger.info("Beginning rsync with options: "+" ".join(options))
+    if len(commands) > 1:
+        logger.info("Transferring in "+str(len(commands))+" streams")
+    started = time()
+    # Each stream appends whole lines to the journal with a single write,
+    # so concurrent streams can share it
+    with ThreadPoolExecutor(max_workers=len(commands)) as executor:
+        results = list(executor.map(lambda x: runRsync(x, journalPath,
+                                                       logger),
+                                    commands))
+    elapsed = time() - started
+
+    transferred = 0
+    with open(join(folders.adminFolder,
+                   'rsyncFromOrigin.txt'), 'a') as f:
+        for result in results:
+            f.write(str(result)+'\n')
+    for result in results:
+        if result.returncode != 0:
+            logger.warn("Rsync exited with a non-zero return code: " +
+                        str(result.returncode))
+        logger.debug("Rsync output begins")
+        logger.debug(result.args)
+        logger.debug(result.returncode)
+        for line in result.stdout.split('\n'):
+            logger.debug(line)
+        logger.debug("Rsync output ends")
+        found = search('Total transferred file size: ([0-9,.]+)',
+                       result.stdout)
+        if found:
+            transferred += int(found.group(1).replace(',', '')
+                               .replace('.', ''))
+    logThroughput(logger, transferred, elapsed)
+    logger.info("Rsync complete.")
+
+
+def rsyncTarget(item, dataFolder):
+    # Mirror rsync: a trailing slash copies the contents of the item,
+    # otherwise the item itself is created inside the destination
+    if item[-1] == "/" or not isdir(item):
+        return dataFolder
+    return join(dataFolder, basename(item))
+
+
+def copyHashFiles(item, root, folders, logger, rehash=False, index=False):
+    originLog = join(folders.adminFolder, 'fixityFromOrigin.txt')
+    onDiskLog = join(folders.adminFolder, 'fixityOnDisk.txt')
+    originHashes = {}
+    stagedHashes = {}
+    if not rehash:
+        if exists(originLog):
+            originHashes = readFixityLog(originLog)
+        if exists(onDiskLog):
+            stagedHashes = readFixityLog(onDiskLog)
+
+    if isdir(item):
+        pairs = []
+        target = rsyncTarget(item, folders.dataFolder)
+        for dirPath, dirNames, fileNames in walk(item):
+            destDir = normpath(join(target, relpath(dirPath, item)))
+            makedirs(destDir, exist_ok=True)
+            for name in fileNames:
+                pairs.append((join(dirPath, name), join(destDir, name)))
+            # walk lists symlinks to directories as directories without
+            # following them, they're recreated like file symlinks
+            for name in dirNames:
+                if islink(join(dirPath, name)):
+                    pairs.append((join(dirPath, name), join(destDir, name)))
+    else:
+        pairs = [(item, join(folders.dataFolder, basename(item)))]
+
+    logger.info("Beginning single read copy and hash of " +
+                str(len(pairs))+" file(s)")
+    copied = 0
+    copiedBytes = 0
+    started = time()
+    # Record what was just read, so a later rehash of the origin can skip
+    # files that haven't changed since. The staged copies weren't read back,
+    # so they aren't cached and a rehash of staging really reads them.
+    cache = HashCache(join(folders.adminFolder, 'fixityCache.db'))
+    with open(originLog, 'a') as originOut, open(onDiskLog, 'a') as diskOut:
+        for src, dst in pairs:
+            if islink(src):
+                if not islink(dst):
+                    symlink(readlink(src), dst)
+                continue
+            originKey = relpath(src, root)
+            diskKey = relpath(dst, folders.dataFolder)
+            if originKey in originHashes and diskKey in stagedHashes and \
+                    exists(dst) and getsize(dst) == getsize(src):
+                logger.debug("Already transferred: "+originKey)
+                continue
+            sha256Hash, md5Hash, size = copyAndHashFile(src, dst)
+            copystat(src, dst)
+            cache.store(src, stat(src), sha256Hash, md5Hash)
+            originHashes[originKey] = [sha256Hash, md5Hash]
+            stagedHashes[diskKey] = [sha256Hash, md5Hash]
+            originOut.write(fixityLogLine(originKey, sha256Hash, md5Hash))
+            diskOut.write(fixityLogLine(diskKey, sha256Hash, md5Hash))
+            copied += 1
+            copiedBytes += size
+            logger.debug("Copied "+originKey+" ("+str(size)+" bytes)")
+
+    cache.close()
+
+    if isdir(item):
+        for dirPath, dirNames, fileNames in walk(item, topdown=False):
+            copystat(dirPath, join(rsyncTarget(item, folders.dataFolder),
+                                   relpath(dirPath, item)))
+    logger.info("Copy and hash complete, "+str(copied)+" file(s) copied.")
+    logThroughput(logger, copiedBytes, time() - started)
+    if index:
+        logger.info("Writing fixity indexes")
+        writeFixityIndex(originHashes.items(), indexPathFor(originLog))
+        writeFixityIndex(stagedHashes.items(), indexPathFor(onDiskLog))
+    return originHashes, stagedHashes
 # Functions end #
 
 
@@ -127,6 +543,28 @@ def main():
                         "intermediate connection",
                         action="store_true"
     )
+    parser.add_argument(
+                        "--chain-file",
+                        help="Also write the prefix+num to this file, " +
+                        "which should be unique to the job",
+                        action="store"
+    )
+    parser.add_argument(
+                        "--transfer",
+                        help="How to move the files: rsync, or copyhash " +
+                        "to read each file once while writing the origin " +
+                        "and on disk fixity logs",
+                        choices=['rsync', 'copyhash'],
+                        default='rsync',
+                        action="store"
+    )
+    addTransferArguments(parser)
+    parser.add_argument(
+                        "--index",
+                        help="With copyhash, also write compact binary " +
+                        "indexes of the fixity logs",
+                        action="store_true"
+    )
     parser.add_argument(
                         "--weird-root",
                         help="If for some reason you deliberately want to " +
@@ -184,94 +622,37 @@ def main():
     # End user specified log instantiation #
     try:
         # Begin module code #
-        validation = ValidateBase(args.dest_root)
-        if validation[0] != True:
-            logger.critical("Your staging root isn't valid!")
-            exit(1)
-        else:
-            stageRoot = join(*validation[1:])
-
-        destinationAdminRoot = join(stageRoot, 'admin/')
-        destinationDataRoot = join(stageRoot, 'data/')
-        prefix = args.prefix
-
-        if not prefix[-1].isdigit():
-            destFolder = prefixToFolder(destinationDataRoot, prefix)
-            logger.info("Creating new data and admin directories for your " +
-                        "prefix: "+destFolder)
-
-            destinationAdminFolder = join(destinationAdminRoot, destFolder)
-            destinationDataFolder = join(destinationDataRoot, destFolder)
-
-            mkAdminDirArgs = ['mkdir', destinationAdminFolder]
-            mkAdminDirComm = BashCommand(mkAdminDirArgs)
-            assert(mkAdminDirComm.run_command()[0])
-            logger.debug("mkAdminDir output begins")
-            logger.debug(mkAdminDirComm.get_data()[1].args)
-            logger.debug(mkAdminDirComm.get_data()[1].returncode)
-            logger.debug(mkAdminDirComm.get_data()[1].stdout)
-            logger.debug("mkAdminDir output ends")
-
-            mkDataDirArgs = ['mkdir', destinationDataFolder]
-            mkDataDirComm = BashCommand(mkDataDirArgs)
-            assert(mkDataDirComm.run_command()[0])
-            logger.debug("mkDataDir output begins")
-            logger.debug(mkDataDirComm.get_data()[1].args)
-            logger.debug(mkDataDirComm.get_data()[1].returncode)
-            logger.debug(mkDataDirComm.get_data()[1].stdout)
-            logger.debug("mkAdminDir output ends")
-
-            assert(isdir(destinationAdminFolder))
-            assert(isdir(destinationDataFolder))
-
-        else:
-            destFolder = args.prefix
-            logger.info("Attempting to resume transfer into "+destFolder)
-
-            destinationAdminFolder = join(destinationAdminRoot, destFolder)
-            destinationDataFolder = join(destinationDataRoot, destFolder)
-
-            for folder in [destinationAdminFolder, destinationDataFolder]:
-                if not exists(folder):
-                    logger.critical('It looks like you are trying to resume ' +
-                                    'a transfer, but a corresponding data ' +
-                                    'or admin folder is missing! Please ' +
-                                    'remedy this and try again! Exiting (1)')
-                    exit(1)
+        stageRoot = resolveStagingRoot(args.dest_root, 'moveFiles')
+        folders = prepareDestination(stageRoot, args.prefix, logger)
 
         stagingDebugLog = DebugFileHandler(
-            join(destinationAdminFolder, 'log.txt')
+            join(folders.adminFolder, 'log.txt')
         )
         logger.addHandler(stagingDebugLog)
 
-        logger.info("Beginning rsync")
-        rsyncArgs = ['rsync', '-avz', args.item, destinationDataFolder]
-        rsyncCommand = BashCommand(rsyncArgs)
-        assert(rsyncCommand.run_command()[0])
-        with open(join(destinationAdminFolder,
-                       'rsyncFromOrigin.txt'), 'a') as f:
-            f.write(str(rsyncCommand.get_data()[1])+'\n')
-        if rsyncCommand.get_data()[1].returncode != 0:
-            logger.warn("Rsync exited with a non-zero return code: " +
-                        str(rsyncCommand.get_data()[1].returncode))
-        logger.debug("Rsync output begins")
-        logger.debug(rsyncCommand.get_data()[1].args)
-        logger.debug(rsyncCommand.get_data()[1].returncode)
-        for line in rsyncCommand.get_data()[1].stdout.split('\n'):
-            logger.debug(line)
-        logger.debug("Rsync output ends")
-        logger.info("Rsync complete.")
+        if args.transfer == 'copyhash':
+            copyHashFiles(args.item, args.root, folders, logger,
+                          rehash=args.rehash, index=args.index)
+        else:
+            transferFiles(args.item, folders, logger,
+                          options=rsyncOptionsFromArgs(args),
+                          streams=args.streams)
 
         if args.chain:
+            print(folders.folder)
+        if args.chain_file:
             try:
-                folderName = split(destinationDataFolder)[1]
-                with open('/tmp/folderName.txt', 'w') as f:
-                    f.write(folderName)
+                writeChainFile(args.chain_file, folders.folder)
             except Exception as e:
-                logger.critical("ENDS: Failure in writing to tmp for chaining.")
+                logger.critical("ENDS: Failure in writing the chain file " +
+                                "({})".format(e))
+                return 1
         # End module code #
         logger.info("ENDS: COMPLETE")
         return 0
+    except StagingError as e:
+        logger.critical("ENDS: "+str(e))
+        return 1
     except KeyboardInterrupt:
         logger.error("ENDS: Program aborted manually")
         return 131
@@ -18,10 +18,9 @@ from uchicagoldrLogging.filters import UserAndIPFilter
 
 from uchicagoldr.batch import Batch
 
-from uchicagoldrStaging.validation.validateBase import ValidateBase
-from uchicagoldrStaging.population.readExistingFixityLog import \
-    ReadExistingFixityLog
-from uchicagoldrStaging.population.writeFixityLog import WriteFixityLog
+from stagingPipeline import StagingError, resolveStagingRoot, stagingFolders
+from stagingFixity import HashCache, writeFixityLog
+from fixityIndex import indexPathFor, readFixityLog, writeFixityIndex
 # Local package imports end #
 
 # Header info begins #
@@ -39,6 +38,36 @@ This generates the fixity as the files appear on the originating media.
 """
 
 # Functions begin #
+def originHash(item, root, folders, logger, rehash=False, workers=1,
+               paranoid=False, index=False):
+    fixityLog = join(folders.adminFolder, 'fixityFromOrigin.txt')
+
+    logger.debug("Creating batch from original files.")
+    originalFiles = Batch(root, directory=item)
+
+    logger.info("Hashing original files")
+    if rehash:
+        logger.info(
+            "Rehash argumnet passed. Not reading existing hashes."
+        )
+        if not paranoid:
+            logger.info("Reusing cached hashes of unchanged files.")
+    existingHashes = None
+    if not rehash and exists(fixityLog):
+        existingHashes = readFixityLog(fixityLog)
+    if workers > 1:
+        logger.info("Hashing with "+str(workers)+" workers")
+    cache = HashCache(join(folders.adminFolder, 'fixityCache.db'))
+    try:
+        hashes = writeFixityLog(fixityLog, root, originalFiles,
+                                existingHashes=existingHashes, workers=workers,
+                                cache=cache, paranoid=paranoid)
+    finally:
+        cache.close()
+    if index:
+        logger.info("Writing fixity index")
+        writeFixityIndex(hashes.items(), indexPathFor(fixityLog))
+    return hashes
 # Functions end #
 
 
@@ -123,6 +152,25 @@ def main():
                         "hashes, recreate them on this run",
                         action="store_true"
     )
+    parser.add_argument(
+                        "--paranoid",
+                        help="Ignore the hash cache and read every file " +
+                        "that needs hashing",
+                        action="store_true"
+    )
+    parser.add_argument(
+                        "--index",
+                        help="Also write a compact binary index of the " +
+                        "fixity log alongside it",
+                        action="store_true"
+    )
+    parser.add_argument(
+                        "--workers",
+                        help="The number of files to hash concurrently",
+                        type=int,
+                        default=1,
+                        action="store"
+    )
     try:
         args = parser.parse_args()
     except SystemExit:
@@ -173,46 +221,22 @@ def main():
                                        "(y/n)\n")
             if wrongRootGoAnyways is not 'y':
                 exit(1)
-        validation = ValidateBase(args.dest_root)
-        if validation[0] == True:
-            stageRoot = join(*validation[1:])
-        else:
-            logger.critical("Your staging root appears to not be valid!")
-            exit(1)
-        destinationAdminRoot = join(stageRoot, 'admin/')
-        containing_folder = args.containing_folder
-        destinationAdminFolder = join(destinationAdminRoot, containing_folder)
+        stageRoot = resolveStagingRoot(args.dest_root, 'originHash')
+        folders = stagingFolders(stageRoot, args.containing_folder)
 
         stagingDebugLog = DebugFileHandler(
-            join(destinationAdminFolder, 'log.txt')
+            join(folders.adminFolder, 'log.txt')
         )
         logger.addHandler(stagingDebugLog)
 
-        logger.debug("Creating batch from original files.")
-        originalFiles = Batch(args.root, directory=args.item)
-
-        logger.info("Hashing original files")
-        if args.rehash:
-            logger.info(
-                "Rehash argumnet passed. Not reading existing hashes."
-            )
-        existingHashes = None
-        if not args.rehash and exists(
-                join(
-                    destinationAdminFolder, 'fixityFromOrigin.txt'
-                )):
-            existingHashes = ReadExistingFixityLog(
-                join(
-                     destinationAdminFolder, 'fixityFromOrigin.txt'
-                )
-            )
-        WriteFixityLog(join(
-                            destinationAdminFolder,
-                            'fixityFromOrigin.txt'
-                           ),
-                       originalFiles, existingHashes=existingHashes)
+        originHash(args.item, args.root, folders, logger, rehash=args.rehash,
+                   workers=args.workers, paranoid=args.paranoid,
+                   index=args.index)
         logger.info("ENDS: COMPLETE")
         return 0
+    except StagingError as e:
+        logger.critical("ENDS: "+str(e))
+        return 1
     except KeyboardInterrupt:
         logger.error("ENDS: Program aborted manually")
         return 131
@@ -18,10 +18,9 @@ from uchicagoldrLogging.filters import UserAndIPFilter
 
 from uchicagoldr.batch import Batch
 
-from uchicagoldrStaging.validation.validateBase import ValidateBase
-from uchicagoldrStaging.population.readExistingFixityLog import \
-    ReadExistingFixityLog
-from uchicagoldrStaging.population.writeFixityLog import WriteFixityLog
+from stagingPipeline import StagingError, resolveStagingRoot, stagingFolders
+from stagingFixity import HashCache, writeFixityLog
+from fixityIndex import indexPathFor, readFixityLog, writeFixityIndex
 # Local package imports end #
 
 # Header info begins #
@@ -39,6 +38,36 @@ It generates fixity information as the files appear in library disk-space.
 """
 
 # Functions begin #
+def stagingHash(folders, logger, rehash=False, workers=1,
+                paranoid=False, index=False):
+    fixityLog = join(folders.adminFolder, 'fixityOnDisk.txt')
+
+    logger.debug("Creating batch from moved files.")
+    movedFiles = Batch(folders.dataFolder, directory=folders.dataFolder)
+
+    logger.info("Hashing copied files.")
+    existingHashes = None
+    if rehash:
+        logger.info(
+            "Rehash argument passed. Not reading existing hashes."
+        )
+        if not paranoid:
+            logger.info("Reusing cached hashes of unchanged files.")
+    if not rehash and exists(fixityLog):
+        existingHashes = readFixityLog(fixityLog)
+    if workers > 1:
+        logger.info("Hashing with "+str(workers)+" workers")
+    cache = HashCache(join(folders.adminFolder, 'fixityCache.db'))
+    try:
+        hashes = writeFixityLog(fixityLog, folders.dataFolder, movedFiles,
+                                existingHashes=existingHashes, workers=workers,
+                                cache=cache, paranoid=paranoid)
+    finally:
+        cache.close()
+    if index:
+        logger.info("Writing fixity index")
+        writeFixityIndex(hashes.items(), indexPathFor(fixityLog))
+    return hashes
 # Functions end #
 
 
@@ -107,6 +136,25 @@ def main():
                         "hashes, recreate them on this run",
                         action="store_true"
     )
+    parser.add_argument(
+                        "--paranoid",
+                        help="Ignore the hash cache and read every file " +
+                        "that needs hashing",
+                        action="store_true"
+    )
+    parser.add_argument(
+                        "--index",
+                        help="Also write a compact binary index of the " +
+                        "fixity log alongside it",
+                        action="store_true"
+    )
+    parser.add_argument(
+                        "--workers",
+                        help="The number of files to hash concurrently",
+                        type=int,
+                        default=1,
+                        action="store"
+    )
     try:
         args = parser.parse_args()
     except SystemExit:
@@ -153,46 +201,23 @@ def main():
     try:
         logger.info("BEGINS")
         # Begin module code #
-        validation = ValidateBase(args.dest_root)
-        if validation[0] == True:
-            stageRoot = join(*validation[1:])
-        else:
-            logger.critical("ENDS: Your staging root appears to not be valid!")
-            exit(1)
-        destinationAdminRoot = join(stageRoot, 'admin/')
-        destinationDataRoot = join(stageRoot, 'data/')
-        containing_folder = args.containing_folder
-        destinationAdminFolder = join(destinationAdminRoot, containing_folder)
-        destinationDataFolder = join(destinationDataRoot, containing_folder)
+        stageRoot = resolveStagingRoot(args.dest_root, 'stagingHash')
+        folders = stagingFolders(stageRoot, args.containing_folder)
 
         stagingDebugLog = DebugFileHandler(
-            join(destinationAdminFolder, 'log.txt')
+            join(folders.adminFolder, 'log.txt')
         )
         logger.addHandler(stagingDebugLog)
 
-        logger.debug("Creating batch from moved files.")
-        movedFiles = Batch(destinationDataFolder,
-                           directory=destinationDataFolder)
-
-        logger.info("Hashing copied files.")
-        existingHashes = None
-        if args.rehash:
-            logger.info(
-                "Rehash argument passed. Not reading existing hashes."
-            )
-        if not args.rehash and exists(
-                join(destinationAdminFolder, 'fixityOnDisk.txt')
-        ):
-            existingHashes = ReadExistingFixityLog(join(destinationAdminFolder,
-                                                        'fixityOnDisk.txt')
-                                                   )
-        WriteFixityLog(
-            join(destinationAdminFolder, 'fixityOnDisk.txt'),
-            movedFiles, existingHashes=existingHashes
-        )
+        stagingHash(folders, logger, rehash=args.rehash,
+                    workers=args.workers, paranoid=args.paranoid,
+                    index=args.index)
         # End module code #
         logger.info("ENDS: COMPLETE")
         return 0
+    except StagingError as e:
+        logger.critical("ENDS: "+str(e))
+        return 1
     except KeyboardInterrupt:
         logger.error("ENDS: Program aborted manually")
         return 131
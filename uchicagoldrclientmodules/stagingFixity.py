@@ -0,0 +1,168 @@
+# Default package imports begin #
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5, sha256
+from os import stat
+from os.path import abspath, relpath
+from sqlite3 import connect
+# Default package imports end #
+
+# Third party package imports begin #
+# Third party package imports end #
+
+# Local package imports begin #
+# Local package imports end #
+
+# Header info begins #
+__author__ = "Brian Balsamo"
+__copyright__ = "Copyright 2015, The University of Chicago"
+__version__ = "0.0.2"
+__maintainer__ = "Brian Balsamo"
+__email__ = "balsamo@uchicago.edu"
+__status__ = "Development"
+# Header info ends #
+
+"""
+Helpers for computing fixity information in the staging utilities without
+reading a file more than once, written in the same layout the
+uchicagoldrStaging fixity log readers expect.
+"""
+
+# Functions begin #
+blockSize = 1024*1024
+
+
+def fixityLogLine(relPath, sha256Hash, md5Hash):
+    return relPath+"\t"+sha256Hash+"\t"+md5Hash+"\n"
+
+
+def iterFixityLog(fixityLog):
+    with open(fixityLog, 'r') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 3:
+                yield fields[0], [fields[1], fields[2]]
+
+
+def hashFile(path):
+    sha = sha256()
+    md = md5()
+    with open(path, 'rb') as f:
+        block = f.read(blockSize)
+        while block:
+            sha.update(block)
+            md.update(block)
+            block = f.read(blockSize)
+    return sha.hexdigest(), md.hexdigest()
+
+
+def copyAndHashFile(src, dst):
+    # One read of the source feeds both the copy and the digests
+    sha = sha256()
+    md = md5()
+    size = 0
+    with open(src, 'rb') as inFile, open(dst, 'wb') as outFile:
+        block = inFile.read(blockSize)
+        while block:
+            outFile.write(block)
+            sha.update(block)
+            md.update(block)
+            size += len(block)
+            block = inFile.read(blockSize)
+    return sha.hexdigest(), md.hexdigest(), size
+
+
+class HashCache(object):
+    # Digests remembered between runs, keyed by the absolute path and only
+    # trusted while the size, mtime and inode of the file are unchanged.
+    # Callers pass paths relative to wherever they were run from, so they
+    # are made absolute here.
+    commitEvery = 1000
+
+    def __init__(self, dbPath):
+        self.connection = connect(dbPath)
+        self.connection.execute("create table if not exists hashes (" +
+                                "path text primary key, size integer, " +
+                                "mtime integer, inode integer, " +
+                                "sha256 text, md5 text)")
+        self.uncommitted = 0
+
+    def lookup(self, path, statResult):
+        row = self.connection.execute("select size, mtime, inode, sha256, " +
+                                      "md5 from hashes where path = ?",
+                                      (abspath(path),)).fetchone()
+        if row and row[:3] == (statResult.st_size, statResult.st_mtime_ns,
+                               statResult.st_ino):
+            return [row[3], row[4]]
+        return None
+
+    def store(self, path, statResult, sha256Hash, md5Hash):
+        self.connection.execute("insert or replace into hashes values " +
+                                "(?, ?, ?, ?, ?, ?)",
+                                (abspath(path), statResult.st_size,
+                                 statResult.st_mtime_ns, statResult.st_ino,
+                                 sha256Hash, md5Hash))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commitEvery:
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def orderedMap(func, iterable, workers):
+    # Like map(), but spread over a pool of threads. Results come back in
+    # input order and only a bounded number of tasks are queued at once.
+    # hashlib releases the GIL while digesting, so threads are enough to
+    # keep several cores busy.
+    if workers <= 1:
+        for x in iterable:
+            yield func(x)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for x in iterable:
+            pending.append(executor.submit(func, x))
+            if len(pending) >= workers*4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def writeFixityLog(fixityLog, root, batch, existingHashes=None, workers=1,
+                   cache=None, paranoid=False):
+    hashes = dict(existingHashes.items()) if existingHashes else {}
+
+    # The cache is only touched from this thread, the workers just hash
+    def toHash():
+        for item in batch.find_items(from_directory=True):
+            path = item.get_file_path()
+            if relpath(path, root) in hashes:
+                continue
+            statResult = stat(path)
+            cached = None
+            if cache is not None and not paranoid:
+                cached = cache.lookup(path, statResult)
+            yield path, statResult, cached
+
+    def hashEntry(entry):
+        path, statResult, cached = entry
+        if cached is None:
+            return path, statResult, list(hashFile(path)), False
+        return path, statResult, cached, True
+
+    # The hashing is parallel but this is the only writer, so the log comes
+    # out in the same order as the batch regardless of the worker count
+    with open(fixityLog, 'a') as f:
+        for path, statResult, digests, fromCache in orderedMap(hashEntry,
+                                                               toHash(),
+                                                               workers):
+            relPath = relpath(path, root)
+            f.write(fixityLogLine(relPath, digests[0], digests[1]))
+            hashes[relPath] = digests
+            if cache is not None and not fromCache:
+                cache.store(path, statResult, digests[0], digests[1])
+    return hashes
+# Functions end #
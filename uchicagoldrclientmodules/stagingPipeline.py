@@ -0,0 +1,66 @@
+# Default package imports begin #
+from collections import namedtuple
+from os.path import join
+# Default package imports end #
+
+# Third party package imports begin #
+# Third party package imports end #
+
+# Local package imports begin #
+from uchicagoldrStaging.validation.validateBase import ValidateBase
+# Local package imports end #
+
+# Header info begins #
+__author__ = "Brian Balsamo"
+__copyright__ = "Copyright 2015, The University of Chicago"
+__version__ = "0.0.2"
+__maintainer__ = "Brian Balsamo"
+__email__ = "balsamo@uchicago.edu"
+__status__ = "Development"
+# Header info ends #
+
+"""
+Shared result types and failures for the staging utilities, so that the
+individual stages can be chained in a single process by
+ldr_staging_allInOne instead of being run as separate scripts.
+"""
+
+# Functions begin #
+# The folders a transfer is staged into
+StagingFolders = namedtuple('StagingFolders',
+                            ['folder', 'adminFolder', 'dataFolder'])
+
+# The outcome of comparing the origin and on disk fixity information, as
+# counts per classification plus the report listing each file
+AuditResult = namedtuple('AuditResult',
+                         ['good', 'notMoved', 'badHash', 'foreign', 'total',
+                          'report'])
+
+# Everything the staging pipeline produced, as handed back to the caller
+PipelineResult = namedtuple('PipelineResult',
+                            ['folders', 'originHashes', 'stagedHashes',
+                             'audit'])
+
+
+class StagingError(Exception):
+    def __init__(self, stage, message):
+        Exception.__init__(self, message)
+        self.stage = stage
+        self.message = message
+
+    def __str__(self):
+        return "["+self.stage+"] "+self.message
+
+
+def resolveStagingRoot(dest_root, stage):
+    validation = ValidateBase(dest_root)
+    if validation[0] != True:
+        raise StagingError(stage, "Your staging root isn't valid!")
+    return join(*validation[1:])
+
+
+def stagingFolders(stageRoot, folder):
+    return StagingFolders(folder,
+                          join(stageRoot, 'admin/', folder),
+                          join(stageRoot, 'data/', folder))
+# Functions end #